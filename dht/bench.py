@@ -0,0 +1,138 @@
+from dht.ceph import RUSH
+from dht.provision import provision
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+# Parameter sweep over both placement strategies. Every configuration reports
+# provisioning time and peak memory, plus throughput and latency percentiles
+# for lookups, node additions/removals and load balancing, as JSON.
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+def summarize(latencies):
+    # latencies in seconds -> throughput and percentiles in microseconds
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / total if total > 0 else None,
+        "p50_us": percentile(latencies, 50) * 1e6,
+        "p90_us": percentile(latencies, 90) * 1e6,
+        "p99_us": percentile(latencies, 99) * 1e6,
+        "max_us": latencies[-1] * 1e6 if latencies else 0.0,
+    }
+
+def timed(fn, args_list):
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+def bench_config(engine, num_nodes, hash_bits, replicas, lookups, churn, seed, memory=True, workers=1):
+    rng = random.Random(seed)
+    hash_size = 2 ** hash_bits
+    result = {"engine": engine, "nodes": num_nodes, "hash_bits": hash_bits, "replicas": replicas, "workers": workers}
+
+    # Provisioning, timed without tracing and traced separately for peak memory
+    start = time.perf_counter()
+    c = provision(engine, num_nodes, hash_size, replicas, workers=workers)
+    result["provision"] = {"seconds": time.perf_counter() - start}
+    if memory:
+        tracemalloc.start()
+        provision(engine, num_nodes, hash_size, replicas, workers=workers)
+        result["provision"]["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # Point lookups: owner only, then the full replica search
+    keys = [(rng.randrange(hash_size),) for _ in range(lookups)]
+    ceph = isinstance(c, RUSH)
+    if ceph:
+        result["locate"] = timed(c.locate_data, [(k, rng.randint(1, replicas)) for (k,) in keys])
+    else:
+        result["locate"] = timed(c.correct_node, keys)
+    result["lookup"] = timed(c.find_replicas, keys)
+
+    # Node additions followed by removals of the same nodes
+    if ceph:
+        added = []
+        add_latencies = []
+        for _ in range(churn):
+            ids = {node.id for node in c.node_array}
+            start = time.perf_counter()
+            c.add_new_node()
+            add_latencies.append(time.perf_counter() - start)
+            added += [node.id for node in c.node_array if node.id not in ids]
+        result["add_node"] = summarize(add_latencies)
+        result["remove_node"] = timed(c.remove_node, [(node_id,) for node_id in added])
+    else:
+        values = set()
+        while len(values) < min(churn, hash_size - len(c.tokens)):
+            value = rng.randrange(hash_size)
+            if value not in c.tokens:
+                values.add(value)
+        result["add_node"] = timed(c.add_node, [(v,) for v in values])
+        result["remove_node"] = timed(c.remove_node, [(v,) for v in values])
+
+    # Load balancing between the busiest and the idlest node
+    balance_latencies = []
+    for _ in range(churn):
+        if ceph:
+            nodes = sorted(c.node_array, key=lambda n: len(n.store))
+            if len(nodes) < 3:
+                break
+            idle, busy = nodes[0], nodes[-1]
+            args = ([busy.id, busy.weight / 2], [idle.id, idle.weight * 2])
+        else:
+            nodes = sorted(c.nodes, key=lambda n: n.space_used())
+            args = (nodes[-1].value, nodes[0].value, False)
+        start = time.perf_counter()
+        c.load_balance(*args)
+        balance_latencies.append(time.perf_counter() - start)
+    result["load_balance"] = summarize(balance_latencies)
+    return result
+
+def parse_list(text):
+    return [int(v) for v in text.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Cassandra and Ceph placement strategies")
+    parser.add_argument("--engines", default="cassandra,ceph", help="comma separated engines to run (cassandra, ceph, straw2, crush)")
+    parser.add_argument("--nodes", default="8,64", type=parse_list, help="comma separated node counts")
+    parser.add_argument("--hash-bits", default="12,16", type=parse_list, help="comma separated hash space sizes (powers of 2)")
+    parser.add_argument("--replicas", default="1,3", type=parse_list, help="comma separated replication factors")
+    parser.add_argument("--lookups", default=1000, type=int, help="point lookups per configuration")
+    parser.add_argument("--churn", default=5, type=int, help="node additions/removals and load balances per configuration")
+    parser.add_argument("--workers", default=1, type=int, help="processes used for ceph placement batches")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced provisioning run")
+    parser.add_argument("--output", "-o", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for engine in args.engines.split(","):
+        for num_nodes in args.nodes:
+            for hash_bits in args.hash_bits:
+                for replicas in args.replicas:
+                    results.append(bench_config(engine, num_nodes, hash_bits, replicas, args.lookups,
+                                                args.churn, args.seed, not args.no_memory, args.workers))
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
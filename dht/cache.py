@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+MISSING = object()
+
+class PlacementCache():
+    # Bounded LRU map whose entries are tagged with the topology epoch they were
+    # computed in. Bumping the epoch invalidates every entry in O(1); stale
+    # entries count as misses and age out through LRU eviction.
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self):
+        self.epoch += 1
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == self.epoch:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = (self.epoch, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __getstate__(self):
+        # copies start out empty rather than copying every cached placement
+        state = self.__dict__.copy()
+        state["entries"] = OrderedDict()
+        return state
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "epoch": self.epoch}
@@ -1,17 +1,46 @@
-from prettytable import PrettyTable
+from dht.ranges import RangeSet
+from dht.storage import MemoryEngine, key_hash, open_storage, to_bytes
+from collections import namedtuple
+import bisect
+import math
+import random
+import time
+import numpy as np
 
+# One step of a migration plan: stream hash values [start, end) from source to dest
+MoveRecord = namedtuple("MoveRecord", ["source_id", "dest_id", "start", "end"])
+
+def iter_moves(records, chunk_size=None):
+    # Stream move records as MoveRecords, one per interval or per chunk of at
+    # most chunk_size hash values, so a data mover never holds the whole plan
+    for record in records:
+        for start, end in record.get("hash_values").intervals():
+            step = chunk_size or (end - start)
+            for chunk_start in range(start, end, step):
+                yield MoveRecord(record.get("source_id"), record.get("dest_id"), chunk_start, min(end, chunk_start + step))
+
+# Node statuses: RUNNING serves reads and writes, DOWN misses writes (they are kept
+# as hints on another node until it is marked up again), JOINING and LEAVING nodes
+# are streaming their ranges in or out.
 class CassandraNode():
     def __init__(self, id, value):
         self.id = id
         self.value = value
-        self.primary = []
-        self.replicas = set()
+        self.primary = RangeSet()
+        self.replicas = RangeSet()
         self.status = "RUNNING"
         self.new_value = 0
+        self.tokens = [value]    # every token this physical node owns (several with vnodes)
+        self.storage = MemoryEngine()    # payloads of the keys in primary and replicas
+        self.hints = {}    # node id -> writes (hash value, key, value or None for a delete) it missed while down
         
         # Links to other nodes
         self.next = None
         self.prev = None
+        
+        # Position in the ring's token index, set by Cassandra.reindex
+        self.ring = None
+        self.index = 0
     
     def is_correct_loc(self, hash):
         if self.prev.value > self.value:
@@ -23,35 +52,49 @@ class CassandraNode():
                 return True
             return False
         
-    def shift_left(self, cutoff, replication_factor):
-        # Find the indices in the data array to move
-        cond = [e <= cutoff for e in self.primary]
-        if cond[0]:
-            index = cond.index(False)
-        else:
-            index = cond.index(False, cond.index(True))
+    def shift_left(self, cutoff, replication_factor, ring_length):
+        # Called on the successor of a node that was just linked in before it
+        new_node = self.prev
+        num_nodes = len(self.ring.token_nodes)
+        
+        # Find the section of the primary range up to the cutoff
+        move_values = self.primary.intersection(RangeSet.arc(self.prev.prev.value, cutoff, ring_length))
             
-        # Move the indices
-        self.prev.primary += self.primary[:index]
-        self.primary = self.primary[index:]
+        # Move the section, this node keeps it as a replica
+        new_node.primary.update(move_values)
+        self.primary.difference_update(move_values)
+        if replication_factor > 1:
+            self.replicas.update(move_values)
         
-        # Print and move the replicas
+        # With at least as many replicas as nodes every node holds the whole ring
+        if replication_factor >= num_nodes:
+            records = [{"source_id": self.id, "dest_id": new_node.id, "hash_values": move_values}]
+            for i in range(1, num_nodes):
+                array = new_node.nth_left(i).primary.copy()
+                new_node.replicas.update(array)
+                records.append({"source_id": new_node.nth_left(i).id, "dest_id": new_node.id, "hash_values": array})
+            return records
+        
+        # The node RF hops away falls off the end of the section's replica chain
+        dropping = new_node.nth_right(replication_factor)
+        dropping.replicas.difference_update(move_values)
+        records = [{"source_id": dropping.id, "dest_id": new_node.id, "hash_values": move_values}]
+        
+        # Move the replicas
         for i in range(1, replication_factor):
-            array = self.prev.nth_left(replication_factor - i).primary
-            self.prev.nth_right(i).replicas.difference_update(array)
-            self.prev.replicas.update(array)
+            array = new_node.nth_left(replication_factor - i).primary.copy()
+            new_node.nth_right(i).replicas.difference_update(array)
+            new_node.replicas.update(array)
+            records.append({"source_id": new_node.nth_right(i).id, "dest_id": new_node.id, "hash_values": array})
+        return records
 
     def nth_right(self, n):
-        cur_node = self
-        for i in range(n):
-            cur_node = cur_node.next
-        return cur_node
+        ring = self.ring.token_nodes
+        return ring[(self.index + n) % len(ring)]
     
     def nth_left(self, n):
-        cur_node = self
-        for i in range(n):
-            cur_node = cur_node.prev
-        return cur_node
+        ring = self.ring.token_nodes
+        return ring[(self.index - n) % len(ring)]
         
     def space_used(self):
         return len(self.primary) + len(self.replicas)
@@ -60,15 +103,21 @@ class CassandraNode():
         return f"NODE {self.id} VALUE {self.value}"
 
 class Cassandra():
-    def __init__(self, num_nodes, ring_length, replicas):
+    def __init__(self, num_nodes, ring_length, replicas, vnodes=1, storage_dir=None):
         self.nodes = []
         self.ring_length = ring_length
         self.replicas = replicas
+        self.vnodes = vnodes    # tokens per physical node
+        self.storage_dir = storage_dir  # per-node append-only logs, in memory when None
+        
+        if vnodes > 1:
+            self.init_vnodes(num_nodes)
+            return
         
         # Provisioning new nodes
         self.node_distance = int(ring_length / num_nodes)
         for i in range(num_nodes):
-            self.nodes.append(CassandraNode(i, self.node_distance * i))
+            self.nodes.append(self.new_node(i, self.node_distance * i))
         self.next_id = len(self.nodes)
         
         # Link the nodes together
@@ -76,63 +125,281 @@ class Cassandra():
             self.nodes[i].next = self.nodes[i+1] if i != len(self.nodes) - 1 else self.nodes[0]
             self.nodes[i].prev = self.nodes[i-1] if i != 0 else self.nodes[len(self.nodes) - 1]
             
+        # Sorted token index kept in sync with the linked ring
+        self.tokens = [node.value for node in self.nodes]
+        self.token_nodes = list(self.nodes)
+        self.reindex()
+            
         # Initialize data
         self.init_data()
+        
+    def init_vnodes(self, num_nodes):
+        # Evenly spaced tokens, each round of num_nodes tokens handed out in a shuffled
+        # order so that every physical node gets different neighbours around the ring
+        rng = random.Random(0)
+        num_tokens = num_nodes * self.vnodes
+        if num_tokens > self.ring_length:
+            # tokens would repeat, and an arc from a token to itself is the whole ring
+            raise ValueError(f"{num_tokens} tokens do not fit on a ring of length {self.ring_length}")
+        self.nodes = [self.new_node(i, 0) for i in range(num_nodes)]
+        self.next_id = num_nodes
+        self.tokens = [self.ring_length * t // num_tokens for t in range(num_tokens)]
+        self.token_nodes = []
+        for r in range(self.vnodes):
+            self.token_nodes += [self.nodes[i] for i in rng.sample(range(num_nodes), num_nodes)]
+        for node in self.nodes:
+            node.tokens = [token for token, owner in zip(self.tokens, self.token_nodes) if owner is node]
+            node.value = node.tokens[0]
+        self.reindex()
+        self.assign_ownership()
+        
+    def new_node(self, node_id, value):
+        node = CassandraNode(node_id, value)
+        node.storage = open_storage(self.storage_dir, node_id)
+        return node
+        
+    def reindex(self):
+        # Called on every topology change: refresh each node's position in the
+        # token index and drop the cached preference lists
+        self.preference_lists = {}
+        if self.vnodes == 1:
+            for i, node in enumerate(self.token_nodes):
+                node.ring = self
+                node.index = i
+        
+    def __getstate__(self):
+        # copies rebuild the preference lists as they are looked up
+        state = self.__dict__.copy()
+        state["preference_lists"] = {}
+        return state
+        
+    def preference_list(self, token_index):
+        # Distinct physical nodes walking clockwise from a token, owner first
+        nodes = self.preference_lists.get(token_index)
+        if nodes is None:
+            nodes = []
+            for step in range(len(self.tokens)):
+                node = self.token_nodes[(token_index + step) % len(self.tokens)]
+                if node not in nodes:
+                    nodes.append(node)
+                    if len(nodes) == self.replicas:
+                        break
+            self.preference_lists[token_index] = nodes
+        return nodes
+        
+    def assign_ownership(self):
+        # Rebuild every physical node's ranges from the token ring (vnode mode)
+        for node in self.nodes:
+            node.primary = RangeSet()
+            node.replicas = RangeSet()
+        for i in range(len(self.tokens)):
+            section = RangeSet.arc(self.tokens[i-1], self.tokens[i], self.ring_length)
+            nodes = self.preference_list(i)
+            nodes[0].primary.update(section)
+            for node in nodes[1:]:
+                node.replicas.update(section)
+                
+    def owner_intervals(self):
+        # (start, end, node) for every ring section, sorted by start
+        intervals = []
+        for i, node in enumerate(self.token_nodes):
+            for start, end in RangeSet.arc(self.tokens[i-1], self.tokens[i], self.ring_length).intervals():
+                intervals.append((start, end, node))
+        return sorted(intervals, key=lambda interval: interval[0])
+        
+    def held_ranges(self):
+        held = {}
+        for node in self.nodes:
+            held[node] = node.primary.copy()
+            held[node].update(node.replicas)
+        return held
+        
+    def stream_records(self, old_held, old_owners):
+        # Every range a node gained, streamed from the node that was its primary owner
+        starts = [interval[0] for interval in old_owners]
+        moves = {}
+        for node in self.nodes:
+            gained = node.primary.copy()
+            gained.update(node.replicas)
+            gained.difference_update(old_held.get(node, RangeSet()))
+            for start, end in gained.intervals():
+                k = bisect.bisect_right(starts, start) - 1
+                while start < end:
+                    piece_end = min(end, old_owners[k][1])
+                    moves.setdefault((old_owners[k][2], node), RangeSet()).add(start, piece_end)
+                    start = piece_end
+                    k += 1
+        return [self.create_move_record(source, dest, values) for (source, dest), values in moves.items()]
+        
+    def split_tokens(self, count, exclude):
+        # Tokens for a new node: each cuts a 1/(N+1) share of a token's worth of ring
+        # off the start of one of the largest sections, so that the new node ends
+        # up with about as much of the ring as every other node. Equal sections are
+        # taken in a random order, neighbouring tokens would share their replicas.
+        share = max(1, self.ring_length // ((len(self.nodes) + 1) * self.vnodes))
+        rng = random.Random(self.next_id)
+        order = [rng.random() for _ in self.tokens]
+        sections = sorted(range(len(self.tokens)), key=lambda i: ((self.tokens[i] - self.tokens[i-1]) % self.ring_length or self.ring_length, order[i]), reverse=True)
+        tokens = []
+        for i in sections:
+            length = (self.tokens[i] - self.tokens[i-1]) % self.ring_length or self.ring_length
+            token = (self.tokens[i-1] + min(share, length - 1)) % self.ring_length
+            if length >= 2 and token not in exclude and token not in tokens:
+                tokens.append(token)
+            if len(tokens) == count:
+                break
+        return tokens
+        
+    def add_vnode(self, node_value):
+        self.check_new_token(node_value)
+        new_node = self.new_node(self.next_id, node_value)
+        self.next_id += 1
+        new_node.tokens = sorted([node_value] + self.split_tokens(self.vnodes - 1, {node_value}))
+        new_node.status = "JOINING"
+        
+        # Take over one section from many different peers at once
+        old_held = self.held_ranges()
+        old_owners = self.owner_intervals()
+        self.nodes.append(new_node)
+        for token in new_node.tokens:
+            pos = bisect.bisect_left(self.tokens, token)
+            self.tokens.insert(pos, token)
+            self.token_nodes.insert(pos, new_node)
+        self.reindex()
+        self.assign_ownership()
+        records = self.transfer(self.stream_records(old_held, old_owners), old_held=old_held)
+        new_node.status = "RUNNING"
+        return records
+        
+    def remove_vnode(self, node_value):
+        node = self.token_nodes[self.token_index(node_value)]
+        node.status = "LEAVING"
+        self.collect_hints(node)
+        old_held = self.held_ranges()
+        old_owners = self.owner_intervals()
+        self.nodes.remove(node)
+        keep = [i for i, owner in enumerate(self.token_nodes) if owner is not node]
+        self.tokens = [self.tokens[i] for i in keep]
+        self.token_nodes = [self.token_nodes[i] for i in keep]
+        self.reindex()
+        self.assign_ownership()
+        records = self.transfer(self.stream_records(old_held, old_owners), [node], old_held)
+        self.hand_off_hints(node)
+        node.storage.clear()
+        return records
 
     def init_data(self):
-        # Nodes 1 to n
-        for i in range(1, len(self.nodes)):
-            # Find the hash values that this node is a direct successor of
-            self.nodes[i].primary = list(range(self.node_distance * (i - 1) + 1, self.node_distance * i + 1))
+        for i in range(len(self.nodes)):
+            # Find the hash range that this node is a direct successor of
+            # (node 0 wraps around from the last node past zero)
+            self.nodes[i].primary = RangeSet.arc(self.nodes[i-1].value, self.nodes[i].value, self.ring_length)
             
             # Apply replicas
             cur_node = self.nodes[i].next
-            for r in range(self.replicas - 1):
+            for r in range(min(self.replicas, len(self.nodes)) - 1):
                 cur_node.replicas.update(self.nodes[i].primary)
                 cur_node = cur_node.next
                 
-        # Special for node 0
-        self.nodes[0].primary = list(range(self.node_distance * (len(self.nodes)-1) + 1, self.ring_length)) + [0]
-        
-        # Node 0 replicas
-        cur_node = self.nodes[0].next
-        for r in range(self.replicas - 1):
-            cur_node.replicas.update(self.nodes[0].primary)
-            cur_node = cur_node.next
-                
     def add_node(self, node_value):
+        if self.vnodes > 1:
+            return self.add_vnode(node_value)
+            
         # Creating the new node with new ID
-        new_node = CassandraNode(self.next_id, node_value)
+        self.check_new_token(node_value)
+        new_node = self.new_node(self.next_id, node_value)
+        new_node.status = "JOINING"
         self.next_id += 1
         
         # Finding the correct place to put the node in the DHT ring
-        for i in range(len(self.nodes)):
-            if self.nodes[i].is_correct_loc(node_value):
+        pos = bisect.bisect_left(self.tokens, node_value)
+        successor = self.token_nodes[pos % len(self.token_nodes)]
                 
-                # Change the node links
-                self.nodes[i].prev.next = new_node
-                new_node.prev = self.nodes[i].prev
-                new_node.next = self.nodes[i]
-                self.nodes[i].prev = new_node
-                self.nodes.append(new_node)
+        # Change the node links
+        successor.prev.next = new_node
+        new_node.prev = successor.prev
+        new_node.next = successor
+        successor.prev = new_node
+        self.nodes.append(new_node)
+        self.tokens.insert(pos, node_value)
+        self.token_nodes.insert(pos, new_node)
+        self.reindex()
                 
-                # Move data over
-                self.nodes[i].shift_left(node_value, self.replicas)
-                break
+        # Move data over
+        records = self.transfer(successor.shift_left(node_value, self.replicas, self.ring_length))
+        new_node.status = "RUNNING"
+        return records
             
     def remove_node(self, node_value):
-        # Find the index of the node in the DHT ring
-        i = self.get_node_values().index(node_value)
+        if self.vnodes > 1:
+            return self.remove_vnode(node_value)
+            
+        # Find the node in the DHT ring
+        i = self.token_index(node_value)
+        node = self.token_nodes[i]
+        node.status = "LEAVING"
+        self.collect_hints(node)    # so the streams include the writes it missed
+        
+        # The successor takes over the primary range, and every range the leaving node
+        # held gets a replica on the next node past the end of its replica chain
+        # (with as many replicas as nodes left, every node already holds every range)
+        records = [self.create_move_record(node, node.next, node.primary.copy())]
+        if 1 < self.replicas < len(self.nodes):
+            for k in range(self.replicas):
+                dest = node.nth_right(self.replicas - k)
+                records.append(self.create_move_record(node, dest, node.nth_left(k).primary.copy()))
+        node.next.replicas.difference_update(node.primary)
+        node.next.primary.update(node.primary)
+        by_id = {n.id: n for n in self.nodes}
+        for r in records[1:]:
+            by_id[r.get("dest_id")].replicas.update(r.get("hash_values"))
+        
+        # Unlink the node and stream its ranges out
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        self.nodes.remove(node)
+        del self.tokens[i]
+        del self.token_nodes[i]
+        self.reindex()
+        records = self.transfer(records, [node])
+        self.hand_off_hints(node)
+        node.storage.clear()
+        return records
+        
+    def owner_index(self, hash_value):
+        # Binary search for the first token >= hash value, wrapping around the ring
+        i = bisect.bisect_left(self.tokens, hash_value)
+        return i if i < len(self.tokens) else 0
+        
+    def check_new_token(self, node_value):
+        # Two nodes on one token would leave one of them with an empty range
+        pos = bisect.bisect_left(self.tokens, node_value)
+        if pos < len(self.tokens) and self.tokens[pos] == node_value:
+            raise ValueError(f"A node with value {node_value} already exists")
         
-        # Unlink the node
-        self.nodes[i].prev.next = self.nodes[i].next
-        self.nodes[i].next.prev = self.nodes[i].prev
-        self.nodes = self.nodes[:i] + self.nodes[i+1:]
+    def token_index(self, node_value):
+        # Index of the node holding exactly this token
+        i = bisect.bisect_left(self.tokens, node_value)
+        if i == len(self.tokens) or self.tokens[i] != node_value:
+            raise ValueError(f"No node with value {node_value}")
+        return i
+        
+    def move_token(self, node, new_value):
+        # Keep the token index sorted when a node changes its value
+        i = self.token_nodes.index(node, self.token_index(node.value))
+        del self.tokens[i]
+        del self.token_nodes[i]
+        pos = bisect.bisect_left(self.tokens, new_value)
+        self.tokens.insert(pos, new_value)
+        self.token_nodes.insert(pos, node)
+        node.value = new_value
+        node.tokens = [new_value]
+        
+        # Only a token that wraps past zero changes the ring order
+        if pos != i:
+            self.reindex()
         
     def correct_node(self, hash_value):
-        for node in self.nodes:
-            if node.is_correct_loc(hash_value):
-                return node
+        return self.token_nodes[self.owner_index(hash_value)]
     
     def section_len(self, node):
         if node.prev.value > node.value:
@@ -140,8 +407,11 @@ class Cassandra():
         else:
             return node.value - node.prev.value
         
-    def search_data(self, hash_value):
-        status = ""
+    def find_replicas(self, hash_value):
+        if self.vnodes > 1:
+            nodes = self.preference_list(self.owner_index(hash_value))
+            return [node for node in nodes if hash_value in node.primary or hash_value in node.replicas]
+            
         replica_nodes = []
         node = self.correct_node(hash_value)
         
@@ -155,6 +425,27 @@ class Cassandra():
             if hash_value in cur_node.replicas:
                 replica_nodes.append(cur_node)
             cur_node = cur_node.next
+        return replica_nodes
+        
+    def locate_many(self, keys):
+        # Node ids of the owner and its successors for every key, one row per key.
+        # A single searchsorted pass over the sorted tokens finds every owner.
+        keys = np.asarray(keys, dtype=np.int64)
+        owners = np.searchsorted(np.array(self.tokens, dtype=np.int64), keys, side="left") % len(self.tokens)
+        if self.vnodes > 1:
+            # Skip tokens of physical nodes that are already in the replica set
+            unique_owners, inverse = np.unique(owners, return_inverse=True)
+            table = np.full((len(unique_owners), self.replicas), -1, dtype=np.int64)
+            for row, i in enumerate(unique_owners.tolist()):
+                ids = [node.id for node in self.preference_list(i)]
+                table[row, :len(ids)] = ids
+            return table[inverse]
+        node_ids = np.array([node.id for node in self.token_nodes], dtype=np.int64)
+        return node_ids[(owners[:, None] + np.arange(self.replicas)) % len(self.tokens)]
+        
+    def search_data(self, hash_value):
+        status = ""
+        replica_nodes = self.find_replicas(hash_value)
         
         # Print report
         if len(replica_nodes) > 0:
@@ -177,15 +468,17 @@ class Cassandra():
         return min(min_len, self.ring_length - values[len(values) - 1] + values[0])
         
         
-    def load_balance(self, busy_node, idle_node):
+    def load_balance(self, busy_node, idle_node, verbose=True):
+        if self.vnodes > 1:
+            if verbose:
+                print("Virtual nodes spread the load evenly, no load balancing needed.")
+            return []
+            
         # Find where the under/overloaded nodes are
-        node_values = self.get_node_values()
-        o_index = node_values.index(busy_node)
-        u_index = node_values.index(idle_node)
+        o_node = self.token_nodes[self.token_index(busy_node)]
+        u_node = self.token_nodes[self.token_index(idle_node)]
 
         # Initializations
-        o_node = self.nodes[o_index]
-        u_node = self.nodes[u_index]
         o_space = o_node.space_used()
         u_space = u_node.space_used()
         
@@ -231,10 +524,183 @@ class Cassandra():
             record_array.append(self.shrink_right(u_node.nth_left(self.replicas), min(u_shrink_num, threshold // 2)))
             
         # Print the record table
-        t = PrettyTable(["Source ID", "Dest ID", "Values"])
-        for r in record_array:
-            t.add_row([r.get("source_id"), r.get("dest_id"), r.get("hash_values")])
-        print(t)
+        if verbose:
+            from prettytable import PrettyTable
+            t = PrettyTable(["Source ID", "Dest ID", "Values"])
+            for r in record_array:
+                t.add_row([r.get("source_id"), r.get("dest_id"), r.get("hash_values")])
+            print(t)
+        return record_array
+        
+    def auto_balance(self, target_ratio=1.1, max_moved=None, max_rounds=50):
+        # Keep moving token boundaries until the busiest node uses at most target_ratio
+        # times the mean space. Every round greedily applies the shrink_right/expand_right
+        # moves that even out space_used the most, moving at most max_moved hash values.
+        loads = {node: node.space_used() for node in self.nodes}
+        report = {"rounds": 0, "converged": False, "ratio_history": [self.imbalance(loads)],
+                  "values_moved": 0, "seconds": 0.0, "records": []}
+        if self.vnodes > 1:
+            report["converged"] = True
+            return report
+            
+        start = time.perf_counter()
+        while report["rounds"] < max_rounds and report["ratio_history"][-1] > target_ratio:
+            budget = max_moved if max_moved is not None else math.inf
+            moved = report["values_moved"]
+            for _ in range(4 * len(self.nodes)):
+                move = self.best_move(loads, budget)
+                if move is None:
+                    break
+                fn, node, num_values = move
+                record = fn(node, num_values)
+                report["records"].append(record)
+                report["values_moved"] += len(record.get("hash_values"))
+                budget -= num_values
+                
+                # Only the nodes around the moved boundary changed
+                for i in range(-1, self.replicas + 2):
+                    touched = node.nth_right(i)
+                    loads[touched] = touched.space_used()
+                if self.imbalance(loads) <= target_ratio:
+                    break
+            report["rounds"] += 1
+            report["ratio_history"].append(self.imbalance(loads))
+            if report["values_moved"] == moved:
+                break   # no move left that evens out the ring
+        report["converged"] = report["ratio_history"][-1] <= target_ratio
+        report["seconds"] = time.perf_counter() - start
+        return report
+        
+    def imbalance(self, loads):
+        # busiest node's space used over the mean
+        mean = sum(loads.values()) / len(loads)
+        return max(loads.values()) / mean if mean > 0 else 1.0
+        
+    def best_move(self, loads, budget):
+        # (move, node, values) over every token boundary that lowers the sum of squared
+        # loads the most. shrink_right hands values from a node to its nth successor,
+        # expand_right takes them back, so load can flow around the ring either way.
+        best, best_gain = None, 0
+        for node in self.token_nodes:
+            successor = node.nth_right(self.replicas)
+            for fn, giver, taker, section in ((self.shrink_right, node, successor, self.section_len(node)),
+                                              (self.expand_right, successor, node, self.section_len(node.next))):
+                gap = loads[giver] - loads[taker]
+                num_values = min(gap // 2, section - 1, budget)
+                gain = num_values * (gap - num_values)
+                if giver is not taker and num_values >= 1 and gain > best_gain:
+                    best, best_gain = (fn, node, int(num_values)), gain
+        return best
+        
+    def migration_plan(self, records, chunk_size=None):
+        # Streaming form of the records returned by add_node, remove_node and load_balance
+        return iter_moves(records, chunk_size)
+        
+    def transfer(self, records, removed=(), old_held=None):
+        # Copy the payloads of every record from source to dest, then drop them
+        # from the nodes that no longer hold those ranges: the sources, or every
+        # node whose held ranges shrank when the ranges from before are given
+        by_id = {node.id: node for node in list(self.nodes) + list(removed)}
+        if not any(node.storage for node in by_id.values()):
+            return records
+        for r in records:
+            by_id[r.get("dest_id")].storage.load(by_id[r.get("source_id")].storage.export_ranges(r.get("hash_values")))
+        if old_held is None:
+            old_held = {}
+            for r in records:
+                old_held.setdefault(by_id[r.get("source_id")], RangeSet()).update(r.get("hash_values"))
+        for node, held in old_held.items():
+            if node in self.nodes:
+                lost = held.copy()
+                lost.difference_update(node.primary)
+                lost.difference_update(node.replicas)
+                node.storage.drop_ranges(lost)
+        return records
+        
+    def hash_key(self, key):
+        return key_hash(key, self.ring_length)
+        
+    def put(self, key, value):
+        # Write to every replica of the key, returns the nodes written to
+        hash_value = self.hash_key(key)
+        nodes = self.find_replicas(hash_value)
+        for node in nodes:
+            if node.status == "DOWN":
+                self.store_hint(node, nodes, hash_value, to_bytes(key), to_bytes(value))
+            else:
+                node.storage.put(hash_value, to_bytes(key), to_bytes(value))
+        return nodes
+        
+    def get(self, key):
+        hash_value = self.hash_key(key)
+        for node in self.find_replicas(hash_value):
+            if node.status != "DOWN":
+                value = node.storage.get(hash_value, to_bytes(key))
+                if value is not None:
+                    return value
+        return None
+        
+    def delete(self, key):
+        hash_value = self.hash_key(key)
+        deleted = False
+        nodes = self.find_replicas(hash_value)
+        for node in nodes:
+            if node.status == "DOWN":
+                self.store_hint(node, nodes, hash_value, to_bytes(key), None)
+            else:
+                deleted = node.storage.delete(hash_value, to_bytes(key)) or deleted
+        return deleted
+        
+    def mark_down(self, node_value):
+        node = self.token_nodes[self.token_index(node_value)]
+        node.status = "DOWN"
+        return node
+        
+    def mark_up(self, node_value, batch_size=1000):
+        # Bring a node back and replay the writes it missed, returns how many
+        node = self.token_nodes[self.token_index(node_value)]
+        node.status = "RUNNING"
+        return self.collect_hints(node, batch_size)
+        
+    def collect_hints(self, node, batch_size=1000):
+        replayed = 0
+        for substitute in self.nodes:
+            hints = substitute.hints.pop(node.id, [])
+            for start in range(0, len(hints), batch_size):
+                self.replay_hints(node, hints[start:start+batch_size])
+            replayed += len(hints)
+        return replayed
+        
+    def store_hint(self, node, replica_nodes, hash_value, key, value):
+        # Keep a write for a down replica on the first live node past the replica set
+        i = self.owner_index(hash_value)
+        for step in range(len(self.tokens)):
+            substitute = self.token_nodes[(i + step) % len(self.tokens)]
+            if substitute.status != "DOWN" and substitute not in replica_nodes:
+                substitute.hints.setdefault(node.id, []).append((hash_value, key, value))
+                return substitute
+        return None
+        
+    def replay_hints(self, node, hints):
+        # Runs of puts go to the storage engine in one bulk load
+        puts = []
+        for hash_value, key, value in hints:
+            if value is None:
+                node.storage.load(puts)
+                puts = []
+                node.storage.delete(hash_value, key)
+            else:
+                puts.append((hash_value, {key: value}))
+        node.storage.load(puts)
+        
+    def hand_off_hints(self, node):
+        # Hints kept by a node that leaves the ring move to a live node
+        if node.hints:
+            target = next((n for n in self.nodes if n.status != "DOWN"), None)
+            if target is not None:
+                for node_id, hints in node.hints.items():
+                    target.hints.setdefault(node_id, []).extend(hints)
+            node.hints = {}
         
     def create_move_record(self, source, dest, values):
         return {
@@ -244,35 +710,39 @@ class Cassandra():
         }
     
     def shrink_right(self, node, num_values):
-        move_values = node.primary[-num_values:]
-        node.primary = node.primary[:-num_values]
-        node.value = node.primary[-1]
-        node.next.primary = move_values + node.next.primary
-        
-        # Duplicate replica deletion from direct successor
-        node.next.replicas.difference_update(move_values)
+        new_value = (node.value - num_values) % self.ring_length
+        move_values = RangeSet.arc(new_value, node.value, self.ring_length)
+        node.primary.difference_update(move_values)
+        self.move_token(node, new_value)
+        node.next.primary.update(move_values)
         
-        # Replica addition to nth successor
-        node.nth_right(self.replicas).replicas.update(move_values)
+        # Duplicate replica deletion from direct successor, replica addition to
+        # nth successor (without replicas the successor is the new owner)
+        if self.replicas > 1:
+            node.next.replicas.difference_update(move_values)
+            node.nth_right(self.replicas).replicas.update(move_values)
         
-        return self.create_move_record(node, node.nth_right(self.replicas), move_values)
+        return self.transfer([self.create_move_record(node, node.nth_right(self.replicas), move_values)])[0]
 
     def expand_right(self, node, num_values):
-        move_values = node.next.primary[:num_values]
-        node.primary += move_values
-        node.value = node.primary[-1]
-        node.next.primary = node.next.primary[num_values:]
+        new_value = (node.value + num_values) % self.ring_length
+        move_values = RangeSet.arc(node.value, new_value, self.ring_length)
+        node.primary.update(move_values)
+        self.move_token(node, new_value)
+        node.next.primary.difference_update(move_values)
 
-        # Duplicate replica deletion from nth successor
-        node.nth_right(self.replicas).replicas.difference_update(move_values)
+        # Duplicate replica deletion from nth successor, replica addition to
+        # direct successor (without replicas the successor only loses the values)
+        if self.replicas > 1:
+            node.nth_right(self.replicas).replicas.difference_update(move_values)
+            node.next.replicas.update(move_values)
         
-        # Replica addition to direct successor
-        node.next.replicas.update(move_values)
-        
-        return self.create_move_record(node.nth_right(self.replicas), node, move_values)
+        return self.transfer([self.create_move_record(node.nth_right(self.replicas), node, move_values)])[0]
         
             
     def __repr__(self):
+        from prettytable import PrettyTable
+        
         # Stats logging
         t = PrettyTable(["Node ID", "Value", "Space Used", "Status"])
         for node in sorted(self.nodes, key=lambda n: n.value):
@@ -1,38 +1,172 @@
-from prettytable import PrettyTable
-from collections import Counter
+from dht.cache import MISSING, PlacementCache
+from dht.clustermap import MAX_TRIES, NO_CHILD, ClusterMap
+from dht.hashing import SplitMixHash
+from dht.storage import MemoryEngine, key_hash, open_storage, to_bytes
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import math
+import numpy as np
+
+PARALLEL_MIN_PAIRS = 1 << 16    # smaller batches are not worth starting a process pool for
+
+# node_array index for every (value, replica id) pair, -1 where the walk found no node
+def walk_batch(hash_fn,node_ids,thresholds,values,replica_ids):
+    result = np.full(len(values), -1, dtype=np.int64)
+    pending = np.arange(len(values))
+    prepared = hash_fn.prepare(values, replica_ids)
+
+    # only the pairs that are still unplaced get hashed against the next node
+    for nodeIndex, (node_id, threshold) in enumerate(zip(node_ids, thresholds)):
+        if len(pending) == 0:
+            break
+        hit = hash_fn.finish(prepared, node_id) <= threshold
+        result[pending[hit]] = nodeIndex
+        pending = pending[~hit]
+        prepared = prepared[~hit]
+    return result
+
+# straw2 selection: every node draws ln(u) / weight from the hash of the pair and
+# the longest straw (the draw closest to zero) wins. A pair only compares its own
+# draws, so changing one node's weight moves data to or from that node only.
+def longest_straw(hash_fn,node_ids,weights,prepared,excluded=None):
+    # excluded holds node indices per pair that do not take part in its draw
+    result = np.full(len(prepared), -1, dtype=np.int64)
+    best = np.full(len(prepared), -np.inf)
+    with np.errstate(divide="ignore"):
+        for nodeIndex, (node_id, weight) in enumerate(zip(node_ids, weights)):
+            if weight <= 0:
+                continue
+            draw = np.log1p(-hash_fn.finish(prepared, node_id)) / weight
+            if excluded is not None:
+                draw[(excluded == nodeIndex).any(axis=1)] = -np.inf
+            longer = draw > best
+            best[longer] = draw[longer]
+            result[longer] = nodeIndex
+    return result
+
+# rows of node_index grouped by node, as (node_array index, rows) pairs
+def node_groups(node_index):
+    order = np.argsort(node_index, kind="stable")
+    bounds = np.flatnonzero(np.diff(node_index[order])) + 1
+    return [(int(node_index[rows[0]]), rows) for rows in np.split(order, bounds) if len(rows)]
+
+# straw of one given node per pair, the pairs grouped by node_groups
+def own_straws(hash_fn,node_ids,weights,prepared,groups):
+    result = np.full(len(prepared), -np.inf)
+    with np.errstate(divide="ignore"):
+        for nodeIndex, rows in groups:
+            if nodeIndex >= 0 and weights[nodeIndex] > 0:
+                result[rows] = np.log1p(-hash_fn.finish(prepared[rows], node_ids[nodeIndex])) / weights[nodeIndex]
+    return result
+
+# Replicas of a value go to distinct nodes: a replica that draws a node already
+# chosen for the value draws again with replica id r + attempt * rf, up to
+# MAX_TRIES times (like the cluster map's failure domains). The last attempt
+# leaves the chosen nodes out of the draw. params is (node weights, replication factor)
+def straw2_batch(hash_fn,node_ids,params,values,replica_ids):
+    weights, replication_factor = params
+    values = np.asarray(values, dtype=np.int64)
+    columns = np.clip(np.asarray(replica_ids, dtype=np.int64) - 1, 0, replication_factor - 1)
+    columns = np.broadcast_to(columns, values.shape)
+    if len(values) == 0:
+        return np.full(0, -1, dtype=np.int64)
+    unique, inverse = np.unique(values, return_inverse=True)
+    num_replicas = int(columns.max()) + 1
+    chosen = np.full((len(unique), num_replicas), -1, dtype=np.int64)
+    for r in range(num_replicas):
+        pending = np.arange(len(unique))
+        for attempt in range(MAX_TRIES):
+            prepared = hash_fn.prepare(unique[pending], r + 1 + attempt * replication_factor)
+            if attempt == MAX_TRIES - 1:
+                picked = longest_straw(hash_fn, node_ids, weights, prepared, chosen[pending, :r])
+                fallback = picked < 0   # every node with weight is taken, the first draw stands
+                if fallback.any():
+                    picked[fallback] = longest_straw(hash_fn, node_ids, weights, hash_fn.prepare(unique[pending[fallback]], r + 1))
+                done = np.ones(len(pending), dtype=bool)
+            else:
+                picked = longest_straw(hash_fn, node_ids, weights, prepared)
+                done = (picked < 0) | ~(chosen[pending, :r] == picked[:, None]).any(axis=1)
+            chosen[pending[done], r] = picked[done]
+            pending = pending[~done]
+            if len(pending) == 0:
+                break
+    return chosen[inverse, columns]
+
+# placement through a cluster map, params is (cluster map, replication factor)
+def crush_batch(hash_fn,node_ids,params,values,replica_ids):
+    cluster_map, replication_factor = params
+    unique, inverse = np.unique(values, return_inverse=True)
+    devices = cluster_map.select_batch(hash_fn, unique, replication_factor)
+    columns = np.clip(np.asarray(replica_ids, dtype=np.int64) - 1, 0, replication_factor - 1)
+    chosen = devices[inverse, columns]
+
+    # device ids to node_array indices
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids)
+    pos = np.clip(np.searchsorted(node_ids[order], chosen), 0, len(node_ids) - 1)
+    return np.where((chosen != NO_CHILD) & (node_ids[order][pos] == chosen), order[pos], -1)
+
+# process pool worker: place one slice of the shared input arrays into the shared result
+def walk_partition(task):
+    names, length, start, end, batch_fn, hash_fn, node_ids, params = task
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        values, replica_ids, result = [np.ndarray(length, dtype=np.int64, buffer=block.buf) for block in blocks]
+        result[start:end] = batch_fn(hash_fn, node_ids, params, values[start:end], replica_ids[start:end])
+        del values, replica_ids, result
+    finally:
+        for block in blocks:
+            block.close()
 
 class RUSH():
-    def __init__(self, hash_size,replication_factor):
+    def __init__(self, hash_size,replication_factor,hash_fn=None,cache_size=65536,workers=1,storage_dir=None,mode="rush",cluster_map=None):
         self.node_array = []
         self.replication_factor = replication_factor
         self.hash_size = hash_size
+        self.hash_fn = hash_fn if hash_fn is not None else SplitMixHash()    # hash family used for placement
+        self.threshold_key = None   # weight configuration the thresholds were computed for
+        self.thresholds = []
+        self.cache = PlacementCache(cache_size)   # (value, replica id) -> node, reset by bumping its epoch
+        self.workers = workers  # processes used for large placement batches
+        self.storage_dir = storage_dir  # per-node append-only logs, in memory when None
+        self.mode = mode    # "rush" walks node_array in order, "straw2" draws a straw per node,
+                            # "crush" descends a cluster map of racks and hosts
+        if mode not in ("rush", "straw2", "crush"):
+            raise ValueError(f"Unknown placement mode '{mode}'")
+        if cluster_map is None and mode == "crush":
+            cluster_map = ClusterMap()
+        self.cluster_map = cluster_map  # racks and hosts the nodes are in
+        self.map_epoch = None   # cache epoch the cluster map weights were computed for
+        self.map_nodes = {}     # node id -> node for the devices of the cluster map
     
     def add_data(self):
-        dataArray = [i for i in range(self.hash_size)]
-        self.add_array(dataArray)
+        self.add_array(np.arange(self.hash_size, dtype=np.int64))
 
     def calc_hash(self,x,r,cid):
-        hashed = hash((x,r,cid))    # get hash of tuple (x,r,cid)
-        mod = abs(hashed) % 10000   # make hash between 0 and 10,000
-        prob = mod / 10000.0        # make it a probability between 0 and 1
-        return prob
+        return self.hash_fn(x,r,cid)    # probability between 0 and 1
 
-    def search_data(self,value):
-        tableHasData = False
-        t = PrettyTable(["Value", "Replica ID", "Found at Node ID"])
+    # (replica id, node) for every replica of the value that is stored where it hashes to
+    def find_replicas(self,value):
+        replicas = []
 
         # check for the value with each replication id
         for i in range(1,self.replication_factor + 1):
-            #print(f"Value {value} Replica {i}")
             node = self.locate_data(value,i)    # fetch the node this value and replica id hash to
 
             # if the node exists check if this node already has the value were searching for in it
             if node is not None and node.value_in_node(value):
-                tableHasData = True
-                t.add_row([value, i, node.id])
+                replicas.append((i, node))
+        return replicas
+
+    def search_data(self,value):
+        from prettytable import PrettyTable
+        t = PrettyTable(["Value", "Replica ID", "Found at Node ID"])
+        replicas = self.find_replicas(value)
+        for i, node in replicas:
+            t.add_row([value, i, node.id])
         
         # if the value was found then print it, if not then tell the user
-        if tableHasData:
+        if replicas:
             print(str(t))
         else:
             print(f"Value {value} was not found!")
@@ -43,74 +177,372 @@ class RUSH():
             totalWeight += node.weight
         return totalWeight
 
+    # weight of every node in proportion to its capacity (explicit, or its threshold)
     def adjust_weights(self):
-        pass
+        capacities = [node.capacity if node.capacity is not None else node.threshold for node in self.node_array]
+        total = sum(capacities)
+        for node, capacity in zip(self.node_array, capacities):
+            node.weight = capacity / total if total > 0 else 0.0
+        self.cache.bump()
+
+    # change one node's capacity and move the data its new weight calls for
+    def set_capacity(self,node_id,capacity):
+        for node in self.node_array:
+            if node.id == node_id:
+                before = self.placement_state()
+                node.capacity = capacity
+                self.adjust_weights()
+                return self.rebalance(before=before)
+        raise ValueError(f"No node with id {node_id}")
+
+    # weight each node is compared against while walking node_array
+    def placement_thresholds(self):
+        # the walk adds a share of every skipped node's weight to the nodes after it,
+        # which only depends on the weights, so compute it once per weight configuration
+        key = tuple((node.id, node.weight) for node in self.node_array)
+        if key != self.threshold_key:
+            thresholds = []
+            carry = 0.0
+            for nodeIndex, node in enumerate(self.node_array):
+                weight = node.weight + carry
+                thresholds.append(weight)
+                if nodeIndex < len(self.node_array) - 1:
+                    carry += weight / (len(self.node_array) - (nodeIndex+1))
+            self.threshold_key = key
+            self.thresholds = thresholds
+        return self.thresholds
 
     def locate_data(self,value,replica_id): # Finds the node destionation
-        nodeIndex = 0   # reset what node were on
-
-        # copy node weights to new array 
-        nodeWeights = []
+        node = self.cache.get((value,replica_id))
+        if node is MISSING:
+            node = self.walk(value,replica_id)
+            self.cache.put((value,replica_id), node)
+        return node
+
+    def walk(self,value,replica_id):
+        if self.mode == "straw2":
+            return self.straw2(value,replica_id)
+        if self.mode == "crush":
+            self.refresh_map()
+            return self.map_nodes.get(self.cluster_map.select(self.hash_fn, value, replica_id, self.replication_factor))
+        # if prob <= adjusted weight then place the value in this node
+        for node, threshold in zip(self.node_array, self.placement_thresholds()):
+            if self.calc_hash(value,replica_id,node.id) <= threshold:
+                return node
+
+    def longest_straw(self,value,replica_id,excluded=()):
+        best, best_draw = None, -math.inf
         for node in self.node_array:
-            nodeWeights.append(node.weight)
-        #print(nodeWeights)
-
-        # loop through every node weight to see if we should place the value there
-        for weight in nodeWeights:    # check which node it should be added to
-            values_hash = self.calc_hash(value,replica_id,self.node_array[nodeIndex].id)  # get hash
-            #print(f"Node: {self.node_array[nodeIndex].id} Hash: {values_hash} Weight: {node_weight}")
-
-            # if prob <= weight then place the value in this node
-            if values_hash <= nodeWeights[nodeIndex]:
-                #print(f"Adding value {value} to node {self.node_array[nodeIndex]}")
-                return self.node_array[nodeIndex] # return the node where it should be appended
-            
-            weightIndex = nodeIndex
-            # chnage weights for current set of nodes were considering for value placement
-            for curWeight in nodeWeights[nodeIndex+1:]:
-                #print(f"curWeight before {curWeight}")
-                #print(f"{curWeight} + ({weight} / ({len(nodeWeights)} - {nodeIndex+1}))")
-                curWeight = curWeight + (weight/ (len(nodeWeights) - (nodeIndex+1)))
-                try:
-                    nodeWeights[weightIndex+1] = curWeight
-                except:
-                    pass
-                #weight = curWeight
-                #print(f"curWeight after {curWeight}")
-                weightIndex += 1
-            #print(nodeWeights)
-            nodeIndex += 1
+            if node.weight > 0 and node not in excluded:
+                draw = math.log1p(-self.calc_hash(value,replica_id,node.id)) / node.weight
+                if draw > best_draw:
+                    best, best_draw = node, draw
+        return best
+
+    # the replicas before this one are drawn as well, a node already holding
+    # one of them is passed over (same retries as straw2_batch)
+    def straw2(self,value,replica_id):
+        replica_id = min(max(replica_id, 1), self.replication_factor)
+        chosen = []
+        for r in range(1, replica_id + 1):
+            for attempt in range(MAX_TRIES):
+                rid = r + attempt * self.replication_factor
+                if attempt == MAX_TRIES - 1:
+                    node = self.longest_straw(value, rid, chosen) or self.longest_straw(value, r)
+                    break
+                node = self.longest_straw(value, rid)
+                if node is None or node not in chosen:
+                    break
+            chosen.append(node)
+        return chosen[-1]
+
+    # cluster map weights follow the node weights, refreshed once per cache epoch
+    def refresh_map(self):
+        if self.map_epoch != self.cache.epoch:
+            self.cluster_map.update_weights({node.id: node.weight for node in self.node_array})
+            self.map_nodes = {node.id: node for node in self.node_array}
+            self.map_epoch = self.cache.epoch
+
+    # batch placement function and the per-node parameters it takes
+    def placement_batch(self):
+        if self.mode == "crush":
+            self.refresh_map()
+            return crush_batch, (self.cluster_map, self.replication_factor)
+        if self.mode == "straw2":
+            return straw2_batch, ([node.weight for node in self.node_array], self.replication_factor)
+        return walk_batch, self.placement_thresholds()
+
+    # batch version of locate_data, returns the node_array index for every
+    # (value, replica id) pair or -1 where the walk found no node
+    def locate_batch(self,values,replica_ids):
+        values = np.asarray(values, dtype=np.int64)
+        replica_ids = np.broadcast_to(np.asarray(replica_ids, dtype=np.int64), values.shape)
+        node_ids = [node.id for node in self.node_array]
+        batch_fn, params = self.placement_batch()
+        if self.workers > 1 and len(values) >= PARALLEL_MIN_PAIRS:
+            return self.parallel_walk(batch_fn, params, node_ids, values, replica_ids)
+        return batch_fn(self.hash_fn, node_ids, params, values, replica_ids)
+
+    # split a batch across a process pool, inputs and results are shared memory arrays
+    def parallel_walk(self,batch_fn,params,node_ids,values,replica_ids):
+        blocks = [shared_memory.SharedMemory(create=True, size=8 * len(values)) for _ in range(3)]
+        shared = None
+        try:
+            shared = [np.ndarray(len(values), dtype=np.int64, buffer=block.buf) for block in blocks]
+            shared[0][:] = values
+            shared[1][:] = replica_ids
+
+            # a few partitions per worker so uneven slices even out
+            bounds = np.linspace(0, len(values), 4 * self.workers + 1).astype(np.int64).tolist()
+            names = [block.name for block in blocks]
+            tasks = [(names, len(values), bounds[i], bounds[i+1], batch_fn, self.hash_fn, node_ids, params)
+                     for i in range(len(bounds) - 1)]
+            with ProcessPoolExecutor(self.workers) as pool:
+                list(pool.map(walk_partition, tasks))
+            result = shared[2].copy()
+        finally:
+            shared = None   # views into the blocks have to go before they can be closed
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return result
+
+    # locate_batch with the values the walk misses going to the last node
+    def assign_batch(self,values,replica_ids):
+        indices = self.locate_batch(values,replica_ids)
+        # if we didnt find a node to insert the value in put it in the last node
+        indices[indices < 0] = len(self.node_array) - 1
+        return indices
+
+    # node id of every replica of every key, one row per key
+    def locate_many(self,keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.repeat(keys, self.replication_factor)
+        replica_ids = np.tile(np.arange(1, self.replication_factor + 1), len(keys))
+        node_ids = np.array([node.id for node in self.node_array], dtype=np.int64)
+        return node_ids[self.assign_batch(values, replica_ids)].reshape(len(keys), self.replication_factor)
+
+    # place (value, replica id) pairs and append the values to their nodes
+    def place_batch(self,values,replica_ids):
+        values = np.asarray(values, dtype=np.int64)
+        indices = self.assign_batch(values,replica_ids)
+
+        # group the values by node while keeping their input order
+        order = np.argsort(indices, kind="stable")
+        counts = np.bincount(indices, minlength=len(self.node_array))
+        replica_ids = np.broadcast_to(np.asarray(replica_ids, dtype=np.int64), values.shape)
+        start = 0
+        for node, count in zip(self.node_array, counts.tolist()):
+            node.store.extend(values[order[start:start+count]], replica_ids[order[start:start+count]])
+            start += count
+
+    # every stored (value, replica id) pair with the index of the node holding it
+    def stored_pairs(self,nodes):
+        sizes = [len(node.store) for node in nodes]
+        values = np.concatenate([node.data_array for node in nodes] + [np.empty(0, dtype=np.int64)])
+        replica_ids = np.concatenate([node.replica_array for node in nodes] + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+        owners = np.repeat(np.arange(len(nodes)), sizes)
+        return values, replica_ids, owners
 
     # allocate data to nodes but dont create new replicas
     def add_array_no_replica(self):
-        allValues = []
+        values, replica_ids, owners = self.stored_pairs(self.node_array)
+        payloads = {}
         for node in self.node_array:
-            for value in node.data_array:
-                allValues.append(value)
+            payloads.update(node.storage.groups)
+            node.storage.clear()
         self.clear_node_data()
+        self.place_batch(values, replica_ids)
 
-        valDict = Counter(allValues)
-
-        for value in valDict: # loop through every input value
-            for replicaId in range(1,valDict[value]+1):
-                #print(f"Value {value} Replica {i}")
-                node = self.locate_data(value,replicaId) # what node were hashing to
-                # if we didnt find a node to insert the value in put it in node with lowest node id
-                if node is None:
-                    self.node_array[len(self.node_array)-1].data_array.append(value)
-                else:
-                    node.data_array.append(value)    # append the value to this nodes data array
+        # every node reloads the payloads of the values it now holds
+        if payloads:
+            stored = np.fromiter(payloads, dtype=np.int64, count=len(payloads))
+            for node in self.node_array:
+                held = np.intersect1d(node.data_array, stored).tolist()
+                node.storage.load([(h, dict(payloads[h])) for h in held])
+
+    # node order with the thresholds (rush) or weights (straw2, crush) the stored
+    # pairs were placed with, taken before a change so that rebalance only has to
+    # place again the pairs the change can move
+    def placement_state(self):
+        state = {"nodes": list(self.node_array)}
+        if self.mode == "rush":
+            state["thresholds"] = list(self.placement_thresholds())
+        else:
+            state["weights"] = [node.weight for node in self.node_array]
+        if self.mode == "crush":
+            state["racks"] = self.cluster_map.racks()
+        return state
+
+    # indices of the stored pairs whose node can differ from the placement in before,
+    # pairs of the sources past node_array (removed nodes) always are
+    def affected_pairs(self,before,sources,values,replica_ids,owners):
+        affected = owners >= len(self.node_array)
+        old_nodes = set(before["nodes"])
+        if self.mode == "rush":
+            # a walk only reads the nodes up to the one it stops at. Over the leading old
+            # nodes whose threshold did not grow (by the rank of the hash family, float
+            # drift in the thresholds moves nothing), the pairs passing a node still pass
+            # it, and the pairs it holds stay while their own hash is within its threshold
+            # (the last node also holds the pairs no threshold caught) and no new node
+            # catches them first
+            thresholds = dict(zip(self.node_array, self.placement_thresholds()))
+            rank = self.hash_fn.rank
+            kept = []
+            for node, threshold in zip(before["nodes"], before["thresholds"]):
+                if node not in thresholds or rank(thresholds[node]) > rank(threshold):
+                    break
+                kept.append(node)
+            if kept and len(kept) == len(before["nodes"]) and self.node_array[-1] is not kept[-1]:
+                kept.pop()
+            kept_nodes = set(kept)
+            affected |= np.array([node not in kept_nodes for node in sources], dtype=bool)[owners]
+            for node, threshold in zip(kept, before["thresholds"]):
+                if rank(thresholds[node]) < rank(threshold):
+                    rows = np.flatnonzero(owners == sources.index(node))
+                    prepared = self.hash_fn.prepare(values[rows], replica_ids[rows])
+                    affected[rows[self.hash_fn.finish(prepared, node.id) > thresholds[node]]] = True
+            new = [node for node in self.node_array if node not in old_nodes]
+            rest = np.flatnonzero(~affected)
+            if new and len(rest):
+                caught = walk_batch(self.hash_fn, [node.id for node in new], [thresholds[node] for node in new],
+                                    values[rest], replica_ids[rest]) >= 0
+                affected[rest[caught]] = True
+            return np.flatnonzero(affected)
+
+        # straw2 only compares the straws of a pair, which keep their order when all
+        # weights change by the same factor. Nodes whose weight grew against that
+        # factor (past float rounding) can take any pair, those whose weight shrank
+        # only lose their own.
+        old = dict(zip(before["nodes"], before["weights"]))
+        common = [node.weight / old[node] for node in self.node_array if old.get(node, 0) > 0 and node.weight > 0]
+        if not common:
+            return np.arange(len(values))
+        scale = sorted(common)[len(common) // 2]
+        current = set(self.node_array)
+        lost = {node for node in before["nodes"] if node not in current or node.weight < old[node] * scale * (1 - 1e-9)}
+        gained = [i for i, node in enumerate(self.node_array) if node.weight > old.get(node, 0) * scale * (1 + 1e-9)]
+        if self.mode == "crush":
+            # a smaller device weight shrinks every bucket above it, so the values with a
+            # replica in the same rack can move; a larger one can draw from any rack
+            if gained:
+                return np.arange(len(values))
+            racks = {before["racks"].get(node.id) for node in lost}
+            affected |= np.array([before["racks"].get(node.id) in racks for node in sources], dtype=bool)[owners]
+            return np.flatnonzero(np.isin(values, values[affected]))
+
+        affected |= np.array([node in lost for node in sources], dtype=bool)[owners]
+        affected = np.isin(values, values[affected])
+        rest = np.flatnonzero(~affected)
+        if gained and len(rest):
+            # replica r of a value took the first draw, rather than a retry, when its
+            # node has the longest straw among the nodes of replicas 1..r; then it only
+            # moves if a node that gained weight draws longer
+            node_ids = [node.id for node in self.node_array]
+            weights = [node.weight for node in self.node_array]
+            rf = self.replication_factor
+            unique, inverse = np.unique(values[rest], return_inverse=True)
+            holders = np.full((len(unique), rf), -1, dtype=np.int64)
+            holders[inverse, np.clip(replica_ids[rest], 1, rf) - 1] = owners[rest]
+            moves = (holders < 0).any(axis=1)
+            groups = [node_groups(holders[:, r]) for r in range(rf)]
+            for r in range(rf):
+                prepared = self.hash_fn.prepare(unique, r + 1)
+                own = own_straws(self.hash_fn, node_ids, weights, prepared, groups[r])
+                for j in range(r):
+                    moves |= own_straws(self.hash_fn, node_ids, weights, prepared, groups[j]) >= own
+                with np.errstate(divide="ignore"):
+                    for nodeIndex in gained:
+                        moves |= np.log1p(-self.hash_fn.finish(prepared, node_ids[nodeIndex])) / weights[nodeIndex] >= own
+            affected[rest[moves[inverse]]] = True
+        return np.flatnonzero(affected)
+
+    # move only the (value, replica id) pairs whose node changed, nodes that were
+    # just taken out of node_array are passed in so their data can be handed off.
+    # With the placement state from before the change only the pairs it can move
+    # are placed again, otherwise all of them.
+    def rebalance(self,removed_nodes=(),before=None):
+        sources = self.node_array + list(removed_nodes)
+        values, replica_ids, owners = self.stored_pairs(sources)
+        candidates = np.arange(len(values)) if before is None else self.affected_pairs(before, sources, values, replica_ids, owners)
+        targets = owners.copy()
+        targets[candidates] = self.assign_batch(values[candidates], replica_ids[candidates])
+        moved = candidates[targets[candidates] != owners[candidates]]
+
+        # drop the moving pairs from their old nodes
+        starts = np.cumsum([0] + [len(node.store) for node in sources])
+        for nodeIndex in np.unique(owners[moved]).tolist():
+            sources[nodeIndex].store.keep(targets[starts[nodeIndex]:starts[nodeIndex+1]] == nodeIndex)
+
+        # append them to their new nodes
+        for nodeIndex in np.unique(targets[moved]).tolist():
+            arriving = moved[targets[moved] == nodeIndex]
+            self.node_array[nodeIndex].store.extend(values[arriving], replica_ids[arriving])
+
+        # migration plan, one (value, replica id, source node id, dest node id) record per moved pair
+        source_ids = np.array([node.id for node in sources], dtype=np.int64)
+        plan = np.rec.fromarrays([values[moved], replica_ids[moved], source_ids[owners[moved]], source_ids[targets[moved]]],
+                                 names="value,replica_id,source,dest")
+        self.transfer(sources, values[moved], owners[moved], targets[moved])
+        return plan
+
+    # copy the payloads of moved values to their new nodes, then drop them from
+    # the old nodes that no longer hold any replica of the value
+    def transfer(self,sources,values,owners,targets):
+        if not any(sources[nodeIndex].storage for nodeIndex in np.unique(owners).tolist()):
+            return
+        for source, dest in set(zip(owners.tolist(), targets.tolist())):
+            moving = np.unique(values[(owners == source) & (targets == dest)]).tolist()
+            self.node_array[dest].storage.load(sources[source].storage.export(moving))
+        for nodeIndex in np.unique(owners).tolist():
+            source = sources[nodeIndex]
+            if nodeIndex < len(self.node_array):
+                leaving = np.unique(values[owners == nodeIndex]).tolist()
+                source.storage.drop([v for v in leaving if not source.value_in_node(v)])
+            else:
+                source.storage.clear()
+
+    def hash_key(self,key):
+        return key_hash(key, self.hash_size)
+
+    # nodes holding the replicas of a hash value, placing the value first if it was never added
+    def replica_nodes(self,hash_value):
+        indices = self.assign_batch(np.full(self.replication_factor, hash_value), np.arange(1, self.replication_factor + 1))
+        nodes = [self.node_array[i] for i in indices.tolist()]
+        if not nodes[0].value_in_node(hash_value):
+            self.add_array([hash_value])
+        return nodes
+
+    # write the value to every replica of the key
+    def put(self,key,value):
+        hash_value = self.hash_key(key)
+        nodes = self.replica_nodes(hash_value)
+        for node in nodes:
+            node.storage.put(hash_value, to_bytes(key), to_bytes(value))
+        return nodes
+
+    def get(self,key):
+        hash_value = self.hash_key(key)
+        for _, node in self.find_replicas(hash_value):
+            value = node.storage.get(hash_value, to_bytes(key))
+            if value is not None:
+                return value
+        return None
+
+    def delete(self,key):
+        hash_value = self.hash_key(key)
+        deleted = False
+        for _, node in self.find_replicas(hash_value):
+            deleted = node.storage.delete(hash_value, to_bytes(key)) or deleted
+        return deleted
 
     # allocate data to nodes
     def add_array(self,data_array):
-        arrayIndex = 0      # index of value were on in data_array
-
-        for value in data_array: # loop through every input value
-            for i in range(1,self.replication_factor + 1): # add every replica
-                #print(f"Value {value} Replica {i}")
-                node = self.locate_data(value,i) # what node were hashing to
-                node.data_array.append(value)    # append the value to this nodes data array
-                arrayIndex += 1
+        # add every replica of every input value
+        data_array = np.asarray(data_array, dtype=np.int64)
+        values = np.repeat(data_array, self.replication_factor)
+        replica_ids = np.tile(np.arange(1, self.replication_factor + 1), len(data_array))
+        self.place_batch(values, replica_ids)
 
     # check if this node id already exists in list
     def node_id_exists(self,id):
@@ -122,32 +554,45 @@ class RUSH():
     # erases all data in every node
     def clear_node_data(self):
         for node in self.node_array:
-            node.data_array = []
-
-    # called when user chooses "add node" as input
-    def add_new_node(self,node_id=0):
-        # check if we already have a node with that id
-        if self.node_id_exists(node_id):
-            #print("Node with that id already exists!")
-            self.add_new_node(node_id+1)
-        else:
-            self.node_array.insert(len(self.node_array) - node_id,CephNode(node_id)) # insert node to front of array
-            self.reset_Weights() # sum of all nodes (1 / node weight) should be = 1
-            self.add_array_no_replica()
+            node.store.clear()
+
+    def new_node(self,node_id,rack=None,host=None):
+        node = CephNode(node_id)
+        node.storage = open_storage(self.storage_dir, node_id)
+        if self.cluster_map is not None and node_id not in self.cluster_map.devices:
+            self.cluster_map.add_device(node_id, rack, host)
+        return node
+
+    # called when user chooses "add node" as input, rack and host place it in the cluster map
+    def add_new_node(self,node_id=0,rack=None,host=None):
+        # skip the ids we already have a node with
+        while self.node_id_exists(node_id):
+            node_id += 1
+        before = self.placement_state()
+        self.node_array.insert(len(self.node_array) - node_id,self.new_node(node_id,rack,host)) # insert node to front of array
+        self.cache.bump()
+        self.reset_Weights() # sum of all nodes (1 / node weight) should be = 1
+        return self.rebalance(before=before)
 
     # called when we initialize the nodes with data at start of program
-    def add_node(self,node_val):
-        self.node_array.insert(0,CephNode(node_val)) # insert node to front of array
+    def add_node(self,node_val,rack=None,host=None):
+        self.node_array.insert(0,self.new_node(node_val,rack,host)) # insert node to front of array
+        self.cache.bump()
         self.reset_Weights() # sum of all nodes (1 / node weight) should be = 1
         #self.redistribute_weights()
     
     def reset_Weights(self):
+        # straw2 and cluster map weights follow the node capacities
+        if self.mode in ("straw2", "crush"):
+            return self.adjust_weights()
         # weight for every node is 1 / num of nodes
         for node in self.node_array:
             node.weight = 1 / len(self.node_array)
+        self.cache.bump()
 
     def remove_node(self, node_id):
         try:
+            before = self.placement_state()
             self.node_index = 0
 
             # find the index of the node with node_id
@@ -156,10 +601,13 @@ class RUSH():
                     break
                 self.node_index += 1
             
-            # remove that index from our list
-            self.node_array.pop(self.node_index)
+            # remove that index from our list and hand its data to the remaining nodes
+            node = self.node_array.pop(self.node_index)
+            if self.cluster_map is not None:
+                self.cluster_map.remove_device(node.id)
+            self.cache.bump()
             self.reset_Weights()
-            self.add_array_no_replica()
+            return self.rebalance([node], before)
         except IndexError:
             print("No nodes exist with this ID! Returning to menu...")
     
@@ -176,6 +624,7 @@ class RUSH():
         overWeight = float(over[1])
         underId = int(under[0])
         underWeight = float(under[1])
+        before = self.placement_state()
 
         # change the weights for the specified nodes to the specified weights
         for node in self.node_array:
@@ -185,6 +634,15 @@ class RUSH():
                 node.weight = underWeight
         
         totalWeight = self.sum_weights(self.node_array)
+        if self.mode in ("straw2", "crush"):
+            # scale the other nodes together, which keeps their data where it is
+            others = totalWeight - self.sum_weights([n for n in self.node_array if n.id in (overId, underId)])
+            scale = (1 - (totalWeight - others)) / others if others > 0 else 0.0
+            for node in self.node_array:
+                if node.id != overId and node.id != underId:
+                    node.weight = max(0.0, node.weight * scale)
+            self.cache.bump()
+            return self.rebalance(before=before)
         difference = abs(totalWeight - 1)
         # change weights of remaining nodes so sum of weights is equal to 1
         if totalWeight > 1:
@@ -196,9 +654,18 @@ class RUSH():
                 if node.id != overId and node.id != underId:
                     node.weight = node.weight + (difference / (len(self.node_array) - 2))
         # redistribute the data according to new node weights
-        self.add_array_no_replica()
+        self.cache.bump()
+        return self.rebalance(before=before)
+
+    def __getstate__(self):
+        # copies refresh the cluster map weights on first use, lookups may be
+        # updating them while the engine is copied
+        state = self.__dict__.copy()
+        state["map_epoch"] = None
+        return state
 
     def __repr__(self):
+        from prettytable import PrettyTable
         if ((self.hash_size * self.replication_factor) / len(self.node_array)) < 30:
             t = PrettyTable(["Node ID", "Weight", "Values", "# of Values"])
 
@@ -218,27 +685,138 @@ class RUSH():
 
 
 
+class NodeStore():
+    # (value, replica id) pairs held by a node, kept in growable typed arrays.
+    # Membership goes through a bitmap over the hash space that is built on the
+    # first lookup and kept up to date afterwards.
+    __slots__ = ("values", "replica_ids", "size", "bitmap", "extra")
+
+    def __init__(self):
+        self.values = np.empty(0, dtype=np.int64)
+        self.replica_ids = np.empty(0, dtype=np.int16)
+        self.size = 0
+        self.bitmap = None  # one bit per hash value held by this node
+        self.extra = {}     # value -> copies beyond the first (a node can hold several replicas of a value)
+
+    def __len__(self):
+        return self.size
+
+    # copies leave out the bitmap (and the copy counts kept with it), it is
+    # rebuilt on the first lookup
+    def __getstate__(self):
+        return self.values[:self.size], self.replica_ids[:self.size]
+
+    def __setstate__(self, state):
+        self.values, self.replica_ids = state
+        self.size = len(self.values)
+        self.bitmap = None
+        self.extra = {}
+
+    def pairs(self):
+        return self.values[:self.size], self.replica_ids[:self.size]
+
+    def extend(self, values, replica_ids):
+        values = np.asarray(values, dtype=np.int64)
+        count = len(values)
+        # grow by doubling, read-only buffers (e.g. memory-mapped) get copied on first write
+        if self.size + count > len(self.values) or not self.values.flags.writeable:
+            capacity = max(16, 2 * (self.size + count))
+            new_values = np.empty(capacity, dtype=np.int64)
+            new_replica_ids = np.empty(capacity, dtype=np.int16)
+            new_values[:self.size] = self.values[:self.size]
+            new_replica_ids[:self.size] = self.replica_ids[:self.size]
+            self.values = new_values
+            self.replica_ids = new_replica_ids
+        self.values[self.size:self.size+count] = values
+        self.replica_ids[self.size:self.size+count] = replica_ids
+        self.size += count
+        if self.bitmap is not None:
+            self.count_values(values, 1)
+
+    def keep(self, mask):
+        # drop every pair where mask is False
+        values, replica_ids = self.pairs()
+        if self.bitmap is not None:
+            self.count_values(values[~mask], -1)
+        self.values = values[mask]
+        self.replica_ids = replica_ids[mask]
+        self.size = len(self.values)
+
+    def clear(self):
+        self.values = np.empty(0, dtype=np.int64)
+        self.replica_ids = np.empty(0, dtype=np.int16)
+        self.size = 0
+        self.bitmap = None
+        self.extra = {}
+
+    def contains(self, x):
+        if self.bitmap is None:
+            self.bitmap = np.zeros(0, dtype=np.uint8)
+            self.count_values(self.values[:self.size], 1)
+        i = x >> 3
+        return i < len(self.bitmap) and (int(self.bitmap[i]) >> (x & 7)) & 1 == 1
+
+    def count_values(self, values, delta):
+        # add (delta = 1) or remove (delta = -1) one copy of every value in the bitmap
+        if len(values) == 0:
+            return
+        unique, counts = np.unique(values, return_counts=True)
+        bytes_needed = int(unique[-1] >> 3) + 1
+        if bytes_needed > len(self.bitmap):
+            bitmap = np.zeros(max(bytes_needed, 2 * len(self.bitmap)), dtype=np.uint8)
+            bitmap[:len(self.bitmap)] = self.bitmap
+            self.bitmap = bitmap
+        bits = (1 << (unique & 7)).astype(np.uint8)
+        present = (self.bitmap[unique >> 3] & bits) != 0
+
+        # values that end up with several copies, or had several, need the extra counts
+        multi = counts > 1
+        if self.extra:
+            multi |= np.isin(unique, np.fromiter(self.extra, dtype=np.int64, count=len(self.extra)))
+        cleared = np.ones(len(unique), dtype=bool) if delta < 0 else None
+        for i in np.flatnonzero(multi | (present if delta > 0 else False)).tolist():
+            value = int(unique[i])
+            held = (1 + self.extra.get(value, 0) if present[i] else 0) + delta * int(counts[i])
+            if held > 1:
+                self.extra[value] = held - 1
+            else:
+                self.extra.pop(value, None)
+            if delta < 0:
+                cleared[i] = held <= 0
+
+        if delta > 0:
+            np.bitwise_or.at(self.bitmap, unique >> 3, bits)
+        else:
+            np.bitwise_and.at(self.bitmap, unique[cleared] >> 3, ~bits[cleared])
+
 class CephNode():
+    __slots__ = ("id", "threshold", "capacity", "weight", "store", "storage")
+
     def __init__(self,id):
         self.id = id            
         self.threshold = 10     # max amount of data allowed in the node
+        self.capacity = None    # explicit capacity for adjust_weights, the threshold when None
         self.weight = 0.0       # represents the denominator of node weight
-        self.data_array = []    # data this node contains
-        #raise NotImplementedError
+        self.store = NodeStore() # (value, replica id) pairs this node contains
+        self.storage = MemoryEngine()   # payloads of the keys hashed to those values
+
+    @property
+    def data_array(self):
+        # values this node contains
+        return self.store.pairs()[0]
+
+    @property
+    def replica_array(self):
+        # replica id of each entry in data_array
+        return self.store.pairs()[1]
 
     def values(self):
         # returns the values this node contains in a string
-        allHashes = ''
-        for val in self.data_array:
-            allHashes += str(val) + ' '
-        return allHashes
+        return ' '.join(str(val) for val in self.data_array.tolist())
 
     def value_in_node(self,x):
         # check if x is in this nodes data array
-        if x in self.data_array:
-            return True
-        else:
-            return False
+        return self.store.contains(x)
 
     def __repr__(self):
         return f"Node ID {self.id} Weight {self.weight}"
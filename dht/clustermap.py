@@ -0,0 +1,225 @@
+import math
+import numpy as np
+
+# Hierarchical cluster map: root -> rack -> host -> device (one per CephNode).
+# Every bucket weighs the sum of its children and picks a child by straw2, so a
+# lookup descends the tree in O(depth x fan-out) instead of scanning every node.
+# Replicas of a value go to distinct buckets of the failure domain type (e.g.
+# one replica per rack): a replica that lands in a failure domain already used
+# by the value is retried with a different replica id, up to MAX_TRIES times; the
+# last try leaves the failure domains already used out of the draw.
+LEVELS = ("root", "rack", "host", "device")
+NO_CHILD = np.iinfo(np.int64).min   # no child with any weight
+MAX_TRIES = 10
+DEVICES_PER_HOST = 8    # fan-out of the default layout, nodes added without a host
+HOSTS_PER_RACK = 16     # fill hosts up to this many devices and racks up to this many hosts
+
+class Device():
+    def __init__(self, id):
+        self.id = id            # the CephNode id
+        self.weight = 0.0
+
+class Bucket():
+    def __init__(self, id, type, name):
+        self.id = id            # negative, so bucket and node ids never hash alike
+        self.type = type
+        self.name = name
+        self.children = []      # Buckets, or Devices under a host
+        self.weight = 0.0       # sum of the children's weights
+
+class ClusterMap():
+    def __init__(self, racks=4, failure_domain="rack"):
+        if failure_domain not in LEVELS[1:]:
+            raise ValueError(f"Unknown failure domain '{failure_domain}'")
+        self.failure_domain = failure_domain
+        self.root = Bucket(-1, "root", "root")
+        self.buckets = {-1: self.root}  # bucket id -> Bucket
+        self.names = {}                 # (type, name) -> Bucket
+        self.hosts = {}                 # device id -> host Bucket
+        self.devices = {}               # device id -> Device
+        for i in range(racks):
+            self.add_bucket("rack", f"rack-{i}", self.root)
+
+    def add_bucket(self, type, name, parent, id=None):
+        if id is None:
+            id = min(self.buckets) - 1
+        bucket = Bucket(id, type, name)
+        parent.children.append(bucket)
+        self.buckets[id] = bucket
+        self.names[(type, name)] = bucket
+        return bucket
+
+    def add_device(self, node_id, rack=None, host=None):
+        # Place a node under host (created in rack if new). Without a rack the
+        # node goes to the rack with the fewest devices that still has room, and
+        # without a host to the emptiest host there that is not full, so that no
+        # bucket grows past DEVICES_PER_HOST or HOSTS_PER_RACK children and
+        # racks are added as the map grows.
+        host_bucket = None if host is None else self.names.get(("host", host))
+        if host_bucket is None:
+            if rack is not None:
+                rack_bucket = self.names.get(("rack", rack)) or self.add_bucket("rack", rack, self.root)
+            else:
+                racks = [bucket for bucket in self.root.children if self.has_room(bucket)]
+                rack_bucket = min(racks, key=self.num_devices) if racks else self.new_rack()
+            if host is None:
+                hosts = [bucket for bucket in rack_bucket.children if len(bucket.children) < DEVICES_PER_HOST]
+                host_bucket = min(hosts, key=lambda bucket: len(bucket.children)) if hosts else None
+            if host_bucket is None:
+                host_bucket = self.add_bucket("host", host or f"host-{node_id}", rack_bucket)
+        device = Device(node_id)
+        host_bucket.children.append(device)
+        self.hosts[node_id] = host_bucket
+        self.devices[node_id] = device
+        return device
+
+    def has_room(self, rack):
+        return len(rack.children) < HOSTS_PER_RACK or any(len(host.children) < DEVICES_PER_HOST for host in rack.children)
+
+    def new_rack(self):
+        i = len(self.root.children)
+        while ("rack", f"rack-{i}") in self.names:
+            i += 1
+        return self.add_bucket("rack", f"rack-{i}", self.root)
+
+    def remove_device(self, node_id):
+        host = self.hosts.pop(node_id)
+        host.children.remove(self.devices.pop(node_id))
+
+    def racks(self):
+        # device id -> id of the rack it is in
+        return {device.id: rack.id for rack in self.root.children for host in rack.children for device in host.children}
+
+    def num_devices(self, bucket):
+        if bucket.type == "host":
+            return len(bucket.children)
+        return sum(self.num_devices(child) for child in bucket.children)
+
+    def update_weights(self, node_weights):
+        # Device weights from the nodes, bucket weights summed bottom up
+        for node_id, device in self.devices.items():
+            device.weight = node_weights[node_id]
+        self.sum_weights(self.root)
+
+    def sum_weights(self, bucket):
+        bucket.weight = sum(child.weight if isinstance(child, Device) else self.sum_weights(child)
+                            for child in bucket.children)
+        return bucket.weight
+
+    def straw2(self, hash_fn, bucket, value, replica_id, excluded=()):
+        best, best_draw = None, -math.inf
+        for child in bucket.children:
+            if child.weight > 0 and child not in excluded:
+                draw = math.log1p(-hash_fn(value, replica_id, child.id)) / child.weight
+                if draw > best_draw:
+                    best, best_draw = child, draw
+        return best
+
+    def descend(self, hash_fn, bucket, level, end_level, value, replica_id, excluded=()):
+        # excluded children are only left out of the last step
+        for l in range(level, end_level):
+            if bucket is None:
+                break
+            bucket = self.straw2(hash_fn, bucket, value, replica_id, excluded if l == end_level - 1 else ())
+        return bucket
+
+    def select(self, hash_fn, value, replica_id, replication_factor):
+        # Device id holding one replica of a value, None if the map has no weight
+        domain_level = LEVELS.index(self.failure_domain)
+        domains = []
+        for r in range(1, replica_id + 1):
+            for attempt in range(MAX_TRIES):
+                rid = r + attempt * replication_factor
+                if attempt == MAX_TRIES - 1:
+                    domain = (self.descend(hash_fn, self.root, 0, domain_level, value, rid, domains)
+                              or self.descend(hash_fn, self.root, 0, domain_level, value, rid))
+                    break
+                domain = self.descend(hash_fn, self.root, 0, domain_level, value, rid)
+                if domain is None or domain not in domains:
+                    break
+            domains.append(domain)
+        device = self.descend(hash_fn, domain, domain_level, len(LEVELS) - 1, value, rid)
+        return None if device is None else device.id
+
+    def straw2_batch(self, hash_fn, bucket, prepared, excluded=None):
+        # excluded holds bucket ids per pair that do not take part in its draw
+        result = np.full(len(prepared), NO_CHILD, dtype=np.int64)
+        best = np.full(len(prepared), -np.inf)
+        with np.errstate(divide="ignore"):
+            for child in bucket.children:
+                if child.weight > 0:
+                    draw = np.log1p(-hash_fn.finish(prepared, child.id)) / child.weight
+                    if excluded is not None:
+                        draw[(excluded == child.id).any(axis=1)] = -np.inf
+                    longer = draw > best
+                    best[longer] = draw[longer]
+                    result[longer] = child.id
+        return result
+
+    def descend_batch(self, hash_fn, prepared, current, level, end_level, excluded=None):
+        # One level at a time, the pairs grouped by the bucket they are in;
+        # excluded children are only left out of the last step
+        for l in range(level, end_level):
+            ids, inverse = np.unique(current, return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.cumsum([0] + np.bincount(inverse, minlength=len(ids)).tolist())
+            chosen = np.full(len(current), NO_CHILD, dtype=np.int64)
+            for i, bucket_id in enumerate(ids.tolist()):
+                if bucket_id != NO_CHILD:
+                    rows = order[bounds[i]:bounds[i+1]]
+                    chosen[rows] = self.straw2_batch(hash_fn, self.buckets[bucket_id], prepared[rows],
+                                                     excluded[rows] if excluded is not None and l == end_level - 1 else None)
+            current = chosen
+        return current
+
+    def select_batch(self, hash_fn, values, replication_factor):
+        # Device id of every replica of every value, one row per value
+        values = np.asarray(values, dtype=np.int64)
+        domain_level = LEVELS.index(self.failure_domain)
+        domains = np.full((len(values), replication_factor), NO_CHILD, dtype=np.int64)
+        devices = np.full((len(values), replication_factor), NO_CHILD, dtype=np.int64)
+        for r in range(replication_factor):
+            pending = np.arange(len(values))
+            for attempt in range(MAX_TRIES):
+                prepared = hash_fn.prepare(values[pending], r + 1 + attempt * replication_factor)
+                start = np.full(len(pending), self.root.id, dtype=np.int64)
+                if attempt == MAX_TRIES - 1:
+                    domain = self.descend_batch(hash_fn, prepared, start, 0, domain_level, domains[pending, :r])
+                    fallback = domain == NO_CHILD   # every domain is used, the plain draw stands
+                    if fallback.any():
+                        domain[fallback] = self.descend_batch(hash_fn, prepared[fallback], start[fallback], 0, domain_level)
+                    done = np.ones(len(pending), dtype=bool)
+                else:
+                    domain = self.descend_batch(hash_fn, prepared, start, 0, domain_level)
+                    done = (domain == NO_CHILD) | ~(domains[pending, :r] == domain[:, None]).any(axis=1)
+                rows = pending[done]
+                domains[rows, r] = domain[done]
+                devices[rows, r] = self.descend_batch(hash_fn, prepared[done], domain[done], domain_level, len(LEVELS) - 1)
+                pending = pending[~done]
+                if len(pending) == 0:
+                    break
+        return devices
+
+    def layout(self):
+        # Buckets as (id, type, name, parent id) and devices as (node id, host id), parents first
+        buckets = []
+        devices = []
+        stack = [(self.root, None)]
+        while stack:
+            bucket, parent = stack.pop(0)
+            buckets.append((bucket.id, bucket.type, bucket.name, parent))
+            for child in bucket.children:
+                if isinstance(child, Device):
+                    devices.append((child.id, bucket.id))
+                else:
+                    stack.append((child, bucket.id))
+        return {"failure_domain": self.failure_domain, "buckets": buckets, "devices": devices}
+
+    @classmethod
+    def from_layout(cls, layout):
+        cluster_map = cls(0, layout["failure_domain"])
+        for id, type, name, parent in layout["buckets"][1:]:
+            cluster_map.add_bucket(type, name, cluster_map.buckets[parent], id)
+        for node_id, host_id in layout["devices"]:
+            cluster_map.add_device(node_id, host=cluster_map.buckets[host_id].name)
+        return cluster_map
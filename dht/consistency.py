@@ -0,0 +1,187 @@
+from dht.bench import summarize
+from dht.provision import ENGINES, provision
+from dht.ceph import RUSH
+from dht.storage import to_bytes
+from collections import Counter
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+# Per-request consistency levels: how many replicas have to answer before a
+# read or write returns. Requests go to every replica at once and return as
+# soon as enough of them answered; writes keep going to the slower replicas
+# in the background, reads drop them.
+ONE = "ONE"
+QUORUM = "QUORUM"
+ALL = "ALL"
+
+def required_acks(level, replication_factor):
+    if level == ONE:
+        return 1
+    if level == QUORUM:
+        return replication_factor // 2 + 1
+    if level == ALL:
+        return replication_factor
+    raise ValueError(f"Unknown consistency level '{level}'")
+
+class UnavailableError(Exception):
+    # Fewer live replicas than the consistency level needs
+    pass
+
+class LatencyModel():
+    # Simulated response time of a node: lognormal around the node's median,
+    # with an occasional stall that is tail_factor times longer
+    def __init__(self, median=0.001, sigma=0.3, tail_prob=0.01, tail_factor=20.0, seed=0):
+        self.median = median
+        self.sigma = sigma
+        self.tail_prob = tail_prob
+        self.tail_factor = tail_factor
+        self.medians = {}   # node id -> median for nodes slower or faster than the rest
+        self.rng = random.Random(seed)
+
+    def set_median(self, node_id, median):
+        self.medians[node_id] = median
+
+    def sample(self, node_id):
+        delay = self.rng.lognormvariate(math.log(self.medians.get(node_id, self.median)), self.sigma)
+        if self.rng.random() < self.tail_prob:
+            delay *= self.tail_factor
+        return delay
+
+class Coordinator():
+    def __init__(self, latency=None):
+        self.latency = latency      # LatencyModel, or None to answer immediately
+        self.background = set()     # writes still going to slower replicas
+
+    def replica_set(self, engine, hash_value, write):
+        # Distinct nodes holding a hash value and the replication factor; DOWN nodes
+        # do not answer. A node listed for several replicas acks only once, so the
+        # level can not be met by one node answering for several replicas.
+        if isinstance(engine, RUSH):
+            if write:
+                nodes = engine.replica_nodes(hash_value)
+            else:
+                nodes = [node for _, node in engine.find_replicas(hash_value)]
+            replication_factor = engine.replication_factor
+        else:
+            nodes, replication_factor = engine.find_replicas(hash_value), engine.replicas
+        return list({id(node): node for node in nodes}.values()), replication_factor
+
+    async def replica_call(self, node, fn):
+        if self.latency is not None:
+            await asyncio.sleep(self.latency.sample(node.id))
+        return fn(node)
+
+    async def fan_out(self, nodes, required, fn, finish_all):
+        if len(nodes) < required:
+            raise UnavailableError(f"{required} replicas required but only {len(nodes)} available")
+        tasks = [asyncio.ensure_future(self.replica_call(node, fn)) for node in nodes]
+        results = []
+        for next_done in asyncio.as_completed(tasks):
+            results.append(await next_done)
+            if len(results) == required:
+                break
+        for task in tasks:
+            if task.done():
+                continue
+            if finish_all:
+                self.background.add(task)
+                task.add_done_callback(self.background.discard)
+            else:
+                task.cancel()
+        return results
+
+    async def read(self, engine, key, level=QUORUM):
+        # The value most of the answering replicas agree on
+        hash_value = engine.hash_key(key)
+        key = to_bytes(key)
+        nodes, replication_factor = self.replica_set(engine, hash_value, False)
+        nodes = [node for node in nodes if getattr(node, "status", "RUNNING") != "DOWN"]
+        values = await self.fan_out(nodes, required_acks(level, replication_factor),
+                                    lambda node: node.storage.get(hash_value, key), False)
+        found = Counter(value for value in values if value is not None)
+        return found.most_common(1)[0][0] if found else None
+
+    async def write(self, engine, key, value, level=QUORUM):
+        # Ids of the replicas that acknowledged before returning
+        hash_value = engine.hash_key(key)
+        key, value = to_bytes(key), to_bytes(value)
+
+        def store(node):
+            node.storage.put(hash_value, key, value)
+            return node.id
+
+        nodes, replication_factor = self.replica_set(engine, hash_value, True)
+        live = [node for node in nodes if getattr(node, "status", "RUNNING") != "DOWN"]
+        required = required_acks(level, replication_factor)
+        if len(live) >= required:
+            # hints do not count towards the consistency level
+            for node in nodes:
+                if node not in live:
+                    engine.store_hint(node, nodes, hash_value, key, value)
+        return await self.fan_out(live, required, store, True)
+
+    async def drain(self):
+        if self.background:
+            await asyncio.gather(*self.background)
+
+async def timed_requests(make_request, count, concurrency):
+    latencies = []
+    remaining = [count]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            await make_request()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies)
+
+async def bench_levels(engine, latency, requests, concurrency, seed):
+    # Read and write latency at every level under the same latency model
+    rng = random.Random(seed)
+    keys = [f"key-{i}" for i in range(1000)]
+    for key in keys:
+        engine.put(key, key)
+    coordinator = Coordinator(latency)
+    result = {}
+    for level in (ONE, QUORUM, ALL):
+        result[level] = {
+            "read": await timed_requests(lambda: coordinator.read(engine, rng.choice(keys), level), requests, concurrency),
+            "write": await timed_requests(lambda: coordinator.write(engine, rng.choice(keys), "v", level), requests, concurrency),
+        }
+        await coordinator.drain()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare read/write latency at each consistency level under simulated node latency")
+    parser.add_argument("--engine", default="cassandra", choices=ENGINES)
+    parser.add_argument("--nodes", default=8, type=int)
+    parser.add_argument("--hash-bits", default=16, type=int)
+    parser.add_argument("--replicas", default=3, type=int)
+    parser.add_argument("--vnodes", default=1, type=int, help="tokens per cassandra node")
+    parser.add_argument("--requests", default=2000, type=int, help="requests per level and operation")
+    parser.add_argument("--concurrency", default=4, type=int, help="requests in flight, keep it low so queueing does not hide the latency model")
+    parser.add_argument("--median-ms", default=1.0, type=float, help="median node response time")
+    parser.add_argument("--sigma", default=0.3, type=float, help="lognormal spread of node response times")
+    parser.add_argument("--tail-prob", default=0.01, type=float, help="chance of a stalled response")
+    parser.add_argument("--tail-factor", default=20.0, type=float, help="how much longer a stalled response takes")
+    parser.add_argument("--slow-nodes", default=0, type=int, help="nodes that respond 10 times slower than the rest")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args(argv)
+
+    engine = provision(args.engine, args.nodes, 2 ** args.hash_bits, args.replicas, args.vnodes)
+    latency = LatencyModel(args.median_ms / 1000, args.sigma, args.tail_prob, args.tail_factor, args.seed)
+    nodes = engine.node_array if isinstance(engine, RUSH) else engine.nodes
+    for node in nodes[:args.slow_nodes]:
+        latency.set_median(node.id, 10 * args.median_ms / 1000)
+    result = asyncio.run(bench_levels(engine, latency, args.requests, args.concurrency, args.seed))
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
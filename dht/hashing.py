@@ -0,0 +1,81 @@
+import math
+import numpy as np
+
+MASK = (1 << 64) - 1
+GOLDEN = 0x9E3779B97F4A7C15
+MIX_1 = 0xBF58476D1CE4E5B9
+MIX_2 = 0x94D049BB133111EB
+UNIT = 1.0 / (1 << 53)    # turns the top 53 bits of a hash into a float in [0, 1)
+
+# A hash family maps (value, replica id, node id) to a probability in [0, 1).
+# Besides the scalar call it provides a batch form in two steps: prepare()
+# hashes the (value, replica id) pairs once, finish() combines them with a node id.
+# rank() counts the hash outputs at or below a threshold, two thresholds of the
+# same rank place every pair alike.
+
+def splitmix64(x):
+    z = (x + GOLDEN) & MASK
+    z = ((z ^ (z >> 30)) * MIX_1) & MASK
+    z = ((z ^ (z >> 27)) * MIX_2) & MASK
+    return z ^ (z >> 31)
+
+def splitmix64_array(x):
+    # same mixing as splitmix64 on a uint64 array, overflow wraps mod 2^64
+    with np.errstate(over="ignore"):
+        z = x + np.uint64(GOLDEN)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX_1)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX_2)
+    return z ^ (z >> np.uint64(31))
+
+class SplitMixHash():
+    # Seeded splitmix64 chain, identical in every process and on every machine
+    def __init__(self, seed=0):
+        self.seed = seed & MASK
+
+    def __call__(self, x, r, cid):
+        # int() first, NumPy integers overflow on the 64 bit mask
+        h = splitmix64(splitmix64(self.seed ^ (int(x) & MASK)) ^ (int(r) & MASK))
+        return (splitmix64(h ^ (int(cid) & MASK)) >> 11) * UNIT
+
+    def prepare(self, values, replica_ids):
+        values = np.asarray(values, dtype=np.int64).astype(np.uint64)
+        replica_ids = np.asarray(replica_ids, dtype=np.int64).astype(np.uint64)
+        return splitmix64_array(splitmix64_array(np.uint64(self.seed) ^ values) ^ replica_ids)
+
+    def finish(self, prepared, cid):
+        h = splitmix64_array(prepared ^ np.uint64(int(cid) & MASK))
+        return (h >> np.uint64(11)).astype(np.float64) * UNIT
+
+    def array(self, values, replica_ids, cid):
+        return self.finish(self.prepare(values, replica_ids), cid)
+
+    def rank(self, threshold):
+        # outputs are the multiples of UNIT, scaling by a power of two is exact
+        return min(max(math.floor(threshold * (1 << 53)) + 1, 0), 1 << 53)
+
+class BuiltinHash():
+    # The original placement hash: builtin hash() quantized to 10,000 buckets
+    def __call__(self, x, r, cid):
+        hashed = hash((x,r,cid))    # get hash of tuple (x,r,cid)
+        mod = abs(hashed) % 10000   # make hash between 0 and 10,000
+        prob = mod / 10000.0        # make it a probability between 0 and 1
+        return prob
+
+    def prepare(self, values, replica_ids):
+        return np.stack([np.asarray(values, dtype=np.int64),
+                         np.broadcast_to(np.asarray(replica_ids, dtype=np.int64), np.shape(values))], axis=1)
+
+    def finish(self, prepared, cid):
+        return np.fromiter((self(x,r,cid) for x, r in prepared.tolist()), dtype=np.float64, count=len(prepared))
+
+    def array(self, values, replica_ids, cid):
+        return self.finish(self.prepare(values, replica_ids), cid)
+
+    def rank(self, threshold):
+        # outputs are mod / 10000.0, step past the rounding of threshold * 10000
+        count = min(max(int(threshold * 10000) + 1, 0), 10000)
+        while count > 0 and (count - 1) / 10000.0 > threshold:
+            count -= 1
+        while count < 10000 and count / 10000.0 <= threshold:
+            count += 1
+        return count
@@ -0,0 +1,190 @@
+from dht.ceph import RUSH
+import bisect
+import json
+import time
+
+# Opt-in instrumentation for Cassandra and RUSH engines. instrument(engine)
+# replaces the operations below with timed wrappers on that one engine
+# instance; the classes are left alone, so an engine that is not instrumented
+# runs exactly the code it did before and pays nothing.
+#
+# Every operation gets a call counter and a latency histogram labelled with the
+# method, values moved between nodes are counted as they are streamed, and
+# per-node loads are read as gauges when a snapshot is exported. Calls nest
+# (Cassandra.get calls find_replicas, RUSH.remove_node calls rebalance), and
+# each level is recorded under its own method label.
+
+# histogram upper bounds in seconds, 1us to 10s
+BUCKETS = tuple(m * 10.0 ** e for e in range(-6, 1) for m in (1, 2.5, 5)) + (10.0,)
+
+# operation -> methods timed under it
+CASSANDRA_OPERATIONS = {
+    "lookup": ("correct_node", "find_replicas", "locate_many", "get"),
+    "write": ("put", "delete"),
+    "node_add": ("add_node",),
+    "node_remove": ("remove_node",),
+    "rebalance": ("load_balance", "auto_balance"),
+}
+RUSH_OPERATIONS = {
+    "lookup": ("locate_data", "find_replicas", "locate_many", "get"),
+    "placement": ("place_batch",),
+    "write": ("put", "delete"),
+    "node_add": ("add_node", "add_new_node"),
+    "node_remove": ("remove_node",),
+    "rebalance": ("rebalance",),
+}
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations at or below it), as Prometheus buckets
+        total = 0
+        result = []
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float("inf")
+
+class Metrics():
+    def __init__(self):
+        self.histograms = {}    # (operation, method) -> Histogram
+        self.errors = {}        # (operation, method) -> calls that raised
+        self.moved = {}         # method -> values moved between nodes
+
+    def observe(self, operation, method, seconds):
+        histogram = self.histograms.get((operation, method))
+        if histogram is None:
+            histogram = self.histograms[(operation, method)] = Histogram()
+        histogram.observe(seconds)
+
+    def error(self, operation, method):
+        self.errors[(operation, method)] = self.errors.get((operation, method), 0) + 1
+
+    def count_moved(self, method, values):
+        self.moved[method] = self.moved.get(method, 0) + values
+
+    def reset(self):
+        self.histograms = {}
+        self.errors = {}
+        self.moved = {}
+
+def timed(metrics, operation, method, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            metrics.error(operation, method)
+            raise
+        finally:
+            metrics.observe(operation, method, time.perf_counter() - start)
+    return wrapper
+
+def counted(metrics, method, fn, count):
+    def wrapper(*args, **kwargs):
+        result = fn(*args, **kwargs)
+        metrics.count_moved(method, count(result))
+        return result
+    return wrapper
+
+def operations(engine):
+    return RUSH_OPERATIONS if isinstance(engine, RUSH) else CASSANDRA_OPERATIONS
+
+def instrument(engine, metrics=None):
+    # Wrap the operations of an engine, returns the Metrics they record to.
+    # Safe to call again, e.g. on a deep copy whose wrappers still point at the original.
+    uninstrument(engine)
+    if metrics is None:
+        metrics = Metrics()
+    for operation, methods in operations(engine).items():
+        for method in methods:
+            setattr(engine, method, timed(metrics, operation, method, getattr(engine, method)))
+    if isinstance(engine, RUSH):
+        # the migration plan has one entry per (value, replica id) that moved
+        engine.rebalance = counted(metrics, "rebalance", engine.rebalance, len)
+    else:
+        # every add, remove and balance streams its move records through transfer
+        engine.transfer = counted(metrics, "transfer", engine.transfer,
+                                  lambda records: sum(len(r.get("hash_values")) for r in records))
+    engine.metrics = metrics
+    return metrics
+
+def uninstrument(engine):
+    for name in [m for methods in operations(engine).values() for m in methods] + ["rebalance", "transfer", "metrics"]:
+        engine.__dict__.pop(name, None)
+
+def node_loads(engine):
+    # node id -> (hash values held, stored keys)
+    if isinstance(engine, RUSH):
+        return {node.id: (len(node.store), len(node.storage)) for node in engine.node_array}
+    return {node.id: (node.space_used(), len(node.storage)) for node in engine.nodes}
+
+def label(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+def to_prometheus(engine):
+    # Text exposition format snapshot of an instrumented engine
+    metrics = engine.metrics
+    lines = []
+    for operation in operations(engine):
+        observed = sorted((method, h) for (op, method), h in metrics.histograms.items() if op == operation)
+        if not observed:
+            continue
+        name = f"dht_{operation}_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for method, histogram in observed:
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{label(method=method, le=le)} {total}")
+            lines.append(f"{name}_sum{label(method=method)} {histogram.sum!r}")
+            lines.append(f"{name}_count{label(method=method)} {histogram.count}")
+    lines.append("# TYPE dht_errors_total counter")
+    for (operation, method), count in sorted(metrics.errors.items()):
+        lines.append(f"dht_errors_total{label(operation=operation, method=method)} {count}")
+    lines.append("# TYPE dht_values_moved_total counter")
+    for method, count in sorted(metrics.moved.items()):
+        lines.append(f"dht_values_moved_total{label(method=method)} {count}")
+    loads = node_loads(engine)
+    lines.append("# TYPE dht_node_values gauge")
+    lines += [f"dht_node_values{label(node=node_id)} {values}" for node_id, (values, _) in sorted(loads.items())]
+    lines.append("# TYPE dht_node_keys gauge")
+    lines += [f"dht_node_keys{label(node=node_id)} {keys}" for node_id, (_, keys) in sorted(loads.items())]
+    return "\n".join(lines) + "\n"
+
+def to_json(engine):
+    # The same snapshot as a dict, with estimated percentiles instead of buckets
+    metrics = engine.metrics
+    result = {"operations": {}, "values_moved": dict(metrics.moved), "nodes": {}}
+    for (operation, method), histogram in sorted(metrics.histograms.items()):
+        result["operations"].setdefault(operation, {})[method] = {
+            "count": histogram.count,
+            "errors": metrics.errors.get((operation, method), 0),
+            "seconds": histogram.sum,
+            "p50_us": histogram.quantile(0.5) * 1e6,
+            "p99_us": histogram.quantile(0.99) * 1e6,
+        }
+    for node_id, (values, keys) in sorted(node_loads(engine).items()):
+        result["nodes"][str(node_id)] = {"values": values, "keys": keys}
+    return result
+
+def export(engine, format="prometheus"):
+    if format == "json":
+        return json.dumps(to_json(engine), indent=2)
+    return to_prometheus(engine)
@@ -0,0 +1,18 @@
+from dht.ceph import RUSH
+from dht.cassandra import Cassandra
+
+# Engine names used by the command line tools: "cassandra", or "ceph" (RUSH),
+# "straw2" and "crush" for the RUSH placement modes
+ENGINES = ("cassandra", "ceph", "straw2", "crush")
+
+def provision(engine, num_nodes, hash_size, replicas, vnodes=1, workers=1):
+    # A provisioned engine: RUSH ("ceph", "straw2" or "crush" placement) with
+    # every hash value added, or a Cassandra ring with vnodes tokens per node
+    if engine in ("ceph", "straw2", "crush"):
+        c = RUSH(hash_size, replicas, workers=workers, mode="rush" if engine == "ceph" else engine)
+        for i in range(num_nodes):
+            c.add_node(i)
+        c.add_data()
+    else:
+        c = Cassandra(num_nodes, hash_size, replicas, vnodes)
+    return c
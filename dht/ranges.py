@@ -0,0 +1,101 @@
+import bisect
+
+class RangeSet():
+    # Set of hash values stored as sorted, disjoint half-open intervals [start, end)
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    @classmethod
+    def arc(cls, start, end, ring_length):
+        # Hash values on the ring section (start, end], wrapping around past zero.
+        # A section that starts and ends on the same token covers the whole ring.
+        if start < end:
+            return cls([(start + 1, end + 1)])
+        return cls([(start + 1, ring_length), (0, end + 1)])
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # Merge every interval that overlaps or touches [start, end)
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def remove(self, start, end):
+        if start >= end:
+            return
+        # Cut [start, end) out of every interval that overlaps it
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        if i >= j:
+            return
+        new_starts = []
+        new_ends = []
+        if self.starts[i] < start:
+            new_starts.append(self.starts[i])
+            new_ends.append(start)
+        if self.ends[j-1] > end:
+            new_starts.append(end)
+            new_ends.append(self.ends[j-1])
+        self.starts[i:j] = new_starts
+        self.ends[i:j] = new_ends
+
+    def update(self, other):
+        for start, end in other.intervals():
+            self.add(start, end)
+
+    def difference_update(self, other):
+        for start, end in other.intervals():
+            self.remove(start, end)
+
+    def intersection(self, other):
+        result = RangeSet()
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            if start < end:
+                result.starts.append(start)
+                result.ends.append(end)
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def intervals(self):
+        return list(zip(self.starts, self.ends))
+
+    def copy(self):
+        result = RangeSet()
+        result.starts = list(self.starts)
+        result.ends = list(self.ends)
+        return result
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        return i >= 0 and value < self.ends[i]
+
+    def __len__(self):
+        return sum(end - start for start, end in zip(self.starts, self.ends))
+
+    def __bool__(self):
+        return len(self.starts) > 0
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end)
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self):
+        parts = [str(s) if e - s == 1 else f"{s}-{e - 1}" for s, e in zip(self.starts, self.ends)]
+        return "[" + ", ".join(parts) + "]"
@@ -0,0 +1,138 @@
+from dht.ranges import RangeSet
+from collections import Counter
+import hashlib
+import time
+
+# Anti-entropy repair for a Cassandra ring. Every replica of a token range builds
+# a Merkle tree over its payloads in that range: 2^depth leaves, each the digest
+# of one slice of the range, combined pairwise up to the root. The trees are
+# compared top down, only descending where the replicas disagree, and only the
+# slices whose leaves differ are reconciled and sent over.
+#
+# Payloads carry no timestamps, so a key's value is the one most replicas hold
+# (the earlier node in the preference list wins a tie) and keys missing on a
+# replica are copied to it. A deleted key that survived on one replica comes back.
+# Nodes holding data for a range they do not replicate take no part in the trees:
+# their own keys in the range that no replica has are handed off to the replicas,
+# then they drop the range.
+
+class MerkleTree():
+    def __init__(self, start, end, depth):
+        self.start = start
+        self.end = end
+        self.depth = depth
+        self.levels = []    # levels[0] is [root], levels[depth] are the leaves
+
+    def leaf_range(self, i):
+        width = self.end - self.start
+        return self.start + width * i // 2 ** self.depth, self.start + width * (i + 1) // 2 ** self.depth
+
+    @classmethod
+    def build(cls, storage, start, end, depth):
+        tree = cls(start, end, depth)
+        leaves = []
+        for i in range(2 ** depth):
+            leaf_start, leaf_end = tree.leaf_range(i)
+            digest = hashlib.blake2b(digest_size=16)
+            for hash_value, items in storage.export_ranges(span(leaf_start, leaf_end)):
+                digest.update(hash_value.to_bytes(8, "big"))
+                for key in sorted(items):
+                    value = items[key]
+                    digest.update(len(key).to_bytes(4, "big") + key + len(value).to_bytes(4, "big") + value)
+            leaves.append(digest.digest())
+        tree.levels = [leaves]
+        while len(tree.levels[0]) > 1:
+            below = tree.levels[0]
+            tree.levels.insert(0, [hashlib.blake2b(below[i] + below[i+1], digest_size=16).digest()
+                                   for i in range(0, len(below), 2)])
+        return tree
+
+def span(start, end):
+    ranges = RangeSet()
+    ranges.add(start, end)
+    return ranges
+
+def divergent_leaves(trees):
+    # Leaf indices where the trees disagree, visiting only subtrees that differ
+    leaves = []
+    pending = [(0, 0)]
+    depth = trees[0].depth
+    while pending:
+        level, i = pending.pop()
+        if len({tree.levels[level][i] for tree in trees}) == 1:
+            continue
+        if level == depth:
+            leaves.append(i)
+        else:
+            pending += [(level + 1, 2 * i + 1), (level + 1, 2 * i)]
+    return sorted(leaves)
+
+def reconcile(replicas, ranges):
+    # Bring every replica to the merged contents of the ranges, returns the
+    # number of entries written
+    exports = [dict(node.storage.export_ranges(ranges)) for node in replicas]
+    merged = {}
+    for hash_value in set().union(*exports):
+        group = {}
+        held = [export[hash_value] for export in exports if hash_value in export]
+        for key in set().union(*held):
+            votes = Counter(items[key] for items in held if key in items)
+            best = max(votes.values())
+            # the first replica (in preference order) holding a most common value wins a tie
+            group[key] = next(items[key] for items in held if key in items and votes[items[key]] == best)
+        merged[hash_value] = group
+    written = 0
+    for replica, export in zip(replicas, exports):
+        missing = []
+        for hash_value, group in merged.items():
+            held = export.get(hash_value, {})
+            changed = {key: value for key, value in group.items() if held.get(key) != value}
+            if changed:
+                missing.append((hash_value, changed))
+                written += len(changed)
+        replica.storage.load(missing)
+    return written
+
+def hand_off(replicas, stale, ranges):
+    # Copy the keys of the stale nodes in the ranges that no replica holds to every
+    # replica (the first stale node holding a key wins), returns the number of
+    # entries written
+    handed = {}
+    for node in stale:
+        for hash_value, items in node.storage.export_ranges(ranges):
+            group = handed.setdefault(hash_value, {})
+            for key, value in items.items():
+                if key not in group and all(r.storage.get(hash_value, key) is None for r in replicas):
+                    group[key] = value
+    groups = [(hash_value, group) for hash_value, group in handed.items() if group]
+    for replica in replicas:
+        replica.storage.load(groups)
+    return len(replicas) * sum(len(group) for _, group in groups)
+
+def repair(ring, depth=8):
+    # Repair every token range of a Cassandra ring, after rebuilding the ownership
+    # ranges from the tokens
+    start_time = time.perf_counter()
+    ring.assign_ownership()
+    report = {"ranges": 0, "divergent_leaves": 0, "leaves": 0, "entries_written": 0, "handed_off": 0, "stale_dropped": 0}
+    for i in range(len(ring.tokens)):
+        replicas = ring.preference_list(i)
+        for start, end in RangeSet.arc(ring.tokens[i-1], ring.tokens[i], ring.ring_length).intervals():
+            section = span(start, end)
+            stale = [node for node in ring.nodes if node not in replicas and node.storage.hashes_in(section)]
+            tree_depth = min(depth, max(0, (end - start - 1).bit_length()))
+            trees = [MerkleTree.build(node.storage, start, end, tree_depth) for node in replicas]
+            leaves = divergent_leaves(trees)
+            report["ranges"] += 1
+            report["leaves"] += 2 ** tree_depth
+            report["divergent_leaves"] += len(leaves)
+            for leaf in leaves:
+                leaf_start, leaf_end = trees[0].leaf_range(leaf)
+                report["entries_written"] += reconcile(replicas, span(leaf_start, leaf_end))
+            if stale:
+                report["handed_off"] += hand_off(replicas, stale, section)
+            for node in stale:
+                report["stale_dropped"] += len(node.storage.hashes_in(section))
+                node.storage.drop_ranges(section)
+    report["seconds"] = time.perf_counter() - start_time
+    return report
@@ -0,0 +1,263 @@
+from dht.bench import percentile
+from dht.provision import ENGINES, provision
+from dht.ceph import RUSH
+from dht.consistency import Coordinator
+from dht import metrics, snapshot
+import argparse
+import asyncio
+import copy
+import json
+import random
+import struct
+import time
+
+# Local request-routing service in front of a Cassandra or RUSH engine.
+#
+# Every frame is a 4 byte big-endian length followed by a JSON object. Requests
+# carry an "id" that is echoed in the response, so clients can pipeline many
+# requests on one connection and match responses that come back out of order.
+#   {"id": 1, "op": "locate", "key": 42}              -> replica node ids
+#   {"id": 2, "op": "put", "key": "k", "value": "..."} -> node ids written to
+#   {"id": 3, "op": "get", "key": "k"}                -> stored value or null
+#   {"id": 6, "op": "delete", "key": "k"}             -> whether the key existed
+# put and get take an optional "consistency" of ONE, QUORUM or ALL; without it
+# a put writes every replica and a get returns the first replica that has the key.
+#   {"id": 4, "op": "add_node", "value": 1000}        (value ignored for ceph)
+#   {"id": 5, "op": "remove_node", "value": 1000}
+#   {"id": 7, "op": "metrics", "format": "json"}     (served with --metrics, Prometheus text by default)
+# Responses are {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok": false, "error": "..."}.
+
+HEADER = struct.Struct(">I")
+
+def encode(message):
+    body = json.dumps(message).encode()
+    return HEADER.pack(len(body)) + body
+
+async def read_frame(reader):
+    size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+    return json.loads(await reader.readexactly(size))
+
+class DHTService():
+    def __init__(self, engine, instrument=False):
+        self.engine = engine
+        self.topology_lock = asyncio.Lock()
+        self.coordinator = Coordinator()
+        self.metrics = metrics.instrument(engine) if instrument else None
+
+    async def handle_connection(self, reader, writer):
+        # Requests on one connection are served concurrently, each response is
+        # written as soon as it is ready
+        tasks = set()
+        try:
+            while True:
+                request = await read_frame(reader)
+                task = asyncio.ensure_future(self.respond(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def respond(self, request, writer):
+        try:
+            response = {"id": request.get("id"), "ok": True, "result": await self.dispatch(request)}
+        except Exception as e:
+            response = {"id": request.get("id"), "ok": False, "error": f"{type(e).__name__}: {e}"}
+        writer.write(encode(response))
+        await writer.drain()
+
+    async def dispatch(self, request):
+        op = request.get("op")
+        engine = self.engine    # readers keep the engine they started with
+        if op == "locate":
+            return engine.locate_many([request["key"]])[0].tolist()
+        elif op == "get":
+            if "consistency" in request:
+                value = await self.coordinator.read(engine, request["key"], request["consistency"])
+            else:
+                value = engine.get(request["key"])
+            return None if value is None else value.decode()
+        elif op in ("put", "delete"):
+            # writes wait for a topology change in progress so they land in the new engine
+            async with self.topology_lock:
+                if op == "delete":
+                    return self.engine.delete(request["key"])
+                if "consistency" in request:
+                    return await self.coordinator.write(self.engine, request["key"], request["value"], request["consistency"])
+                return [node.id for node in self.engine.put(request["key"], request["value"])]
+        elif op in ("add_node", "remove_node"):
+            return await self.change_topology(op, request.get("value"))
+        elif op == "metrics" and self.metrics is not None:
+            if request.get("format") == "json":
+                return metrics.to_json(engine)
+            return metrics.to_prometheus(engine)
+        raise ValueError(f"Unknown operation '{op}'")
+
+    async def change_topology(self, op, value):
+        # Copy-on-write: the next engine is built off the event loop and swapped in
+        # afterwards, so lookups never wait for it and keep reading the engine they
+        # started with.
+        async with self.topology_lock:
+            loop = asyncio.get_running_loop()
+            self.engine = await loop.run_in_executor(None, self.changed_engine, self.engine, op, value)
+        return len(self.engine.node_array) if isinstance(self.engine, RUSH) else len(self.engine.nodes)
+
+    def changed_engine(self, engine, op, value):
+        # Only the topology is copied: node storages are forked, sharing their
+        # payloads, and the metrics are shared. Lookups running on the loop at the
+        # same time only fill caches, which copies leave out.
+        nodes = engine.node_array if isinstance(engine, RUSH) else engine.nodes
+        memo = {id(node.storage): node.storage.fork() for node in nodes}
+        if self.metrics is not None:
+            memo[id(self.metrics)] = self.metrics
+        engine = copy.deepcopy(engine, memo)
+        if self.metrics is not None:
+            # the copied wrappers still call into the old engine
+            metrics.instrument(engine, self.metrics)
+        if op == "add_node":
+            if isinstance(engine, RUSH):
+                engine.add_new_node()
+            else:
+                engine.add_node(int(value))
+        else:
+            engine.remove_node(int(value))
+        return engine
+
+    async def serve(self, host="127.0.0.1", port=7000, unix_path=None):
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+class Client():
+    # Pipelining client: any number of requests can be in flight at once
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+        self.pending = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=7000, unix_path=None):
+        if unix_path:
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        try:
+            while True:
+                response = await read_frame(self.reader)
+                future = self.pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    async def request(self, op, **fields):
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.writer.write(encode(dict(fields, id=self.next_id, op=op)))
+        await self.writer.drain()
+        response = await future
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    async def close(self):
+        self.writer.close()
+        self.receiver.cancel()
+
+async def load_generator(key_space, requests=10000, connections=4, pipeline=32, write_ratio=0.1,
+                         host="127.0.0.1", port=7000, unix_path=None, seed=0):
+    # Drive locate/put/get traffic from several pipelined connections and
+    # report requests per second and latency percentiles
+    rng = random.Random(seed)
+    clients = [await Client.connect(host, port, unix_path) for _ in range(connections)]
+    latencies = []
+    errors = 0
+    remaining = [requests]
+
+    async def worker(client):
+        nonlocal errors
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            key = rng.randrange(key_space)
+            roll = rng.random()
+            start = time.perf_counter()
+            try:
+                if roll < write_ratio:
+                    await client.request("put", key=str(key), value=str(key))
+                elif roll < (1 + write_ratio) / 2:
+                    await client.request("get", key=str(key))
+                else:
+                    await client.request("locate", key=key)
+            except RuntimeError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(client) for client in clients for _ in range(pipeline)])
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed if elapsed > 0 else None,
+        "p50_us": percentile(latencies, 50) * 1e6,
+        "p99_us": percentile(latencies, 99) * 1e6,
+        "p999_us": percentile(latencies, 99.9) * 1e6,
+        "max_us": latencies[-1] * 1e6 if latencies else 0.0,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a DHT engine over a socket, or load test a running service")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "bench"):
+        p = sub.add_parser(name)
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", default=7000, type=int)
+        p.add_argument("--unix", help="unix socket path instead of TCP")
+    serve = sub.choices["serve"]
+    serve.add_argument("--engine", default="cassandra", choices=ENGINES)
+    serve.add_argument("--nodes", default=8, type=int)
+    serve.add_argument("--hash-bits", default=16, type=int)
+    serve.add_argument("--replicas", default=3, type=int)
+    serve.add_argument("--vnodes", default=1, type=int, help="tokens per cassandra node")
+    serve.add_argument("--snapshot", help="load the engine from a snapshot file instead")
+    serve.add_argument("--metrics", action="store_true", help="instrument the engine and serve the 'metrics' op")
+    bench = sub.choices["bench"]
+    bench.add_argument("--hash-bits", default=16, type=int, help="keys are drawn from [0, 2**hash_bits)")
+    bench.add_argument("--requests", default=10000, type=int)
+    bench.add_argument("--connections", default=4, type=int)
+    bench.add_argument("--pipeline", default=32, type=int, help="requests in flight per connection")
+    bench.add_argument("--write-ratio", default=0.1, type=float)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        if args.snapshot:
+            engine = snapshot.load(args.snapshot)
+        else:
+            engine = provision(args.engine, args.nodes, 2 ** args.hash_bits, args.replicas, args.vnodes)
+        asyncio.run(DHTService(engine, args.metrics).serve(args.host, args.port, args.unix))
+    else:
+        report = asyncio.run(load_generator(2 ** args.hash_bits, args.requests, args.connections, args.pipeline,
+                                            args.write_ratio, args.host, args.port, args.unix))
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+from dht.cassandra import Cassandra
+from dht.ceph import RUSH
+from dht.clustermap import ClusterMap
+from dht.hashing import BuiltinHash, SplitMixHash
+from dht.ranges import RangeSet
+import json
+import math
+import mmap
+import struct
+import numpy as np
+
+# Snapshot layout:
+#   MAGIC | header length (uint32 little endian) | JSON header | packed arrays
+# The header holds the scalar settings plus the dtype, offset and length of
+# every array. Arrays start on 8 byte boundaries, so a memory-mapped file can
+# back them directly without copying or deserializing any keys.
+# Payloads are not part of a snapshot: log-backed storage is reopened from the
+# storage directory recorded in the header, in-memory storage starts out empty.
+MAGIC = b"DHTSNAP1"
+ALIGN = 8
+
+def pack_ranges(range_sets):
+    # Concatenated interval starts/ends with a count per RangeSet
+    starts = [start for r in range_sets for start in r.starts]
+    ends = [end for r in range_sets for end in r.ends]
+    counts = [len(r.starts) for r in range_sets]
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+def unpack_ranges(starts, ends, counts):
+    range_sets = []
+    offset = 0
+    for count in counts.tolist():
+        r = RangeSet()
+        r.starts = starts[offset:offset+count].tolist()
+        r.ends = ends[offset:offset+count].tolist()
+        range_sets.append(r)
+        offset += count
+    return range_sets
+
+def hash_settings(hash_fn):
+    if isinstance(hash_fn, SplitMixHash):
+        return {"name": "splitmix", "seed": hash_fn.seed}
+    if isinstance(hash_fn, BuiltinHash):
+        return {"name": "builtin"}
+    raise ValueError(f"Cannot snapshot hash family {type(hash_fn).__name__}")
+
+def make_hash(settings):
+    if settings["name"] == "splitmix":
+        return SplitMixHash(settings["seed"])
+    return BuiltinHash()
+
+def cassandra_state(c):
+    primary = pack_ranges([node.primary for node in c.nodes])
+    replicas = pack_ranges([node.replicas for node in c.nodes])
+    header = {
+        "engine": "cassandra",
+        "ring_length": c.ring_length,
+        "replicas": c.replicas,
+        "vnodes": c.vnodes,
+        "next_id": c.next_id,
+        "storage_dir": c.storage_dir,
+        "status": [node.status for node in c.nodes],
+    }
+    arrays = {
+        "node_ids": np.array([node.id for node in c.nodes], dtype=np.int64),
+        "tokens": np.array(c.tokens, dtype=np.int64),
+        "token_node_ids": np.array([node.id for node in c.token_nodes], dtype=np.int64),
+        "primary_starts": primary[0], "primary_ends": primary[1], "primary_counts": primary[2],
+        "replica_starts": replicas[0], "replica_ends": replicas[1], "replica_counts": replicas[2],
+    }
+    return header, arrays
+
+def rush_state(r):
+    header = {
+        "engine": "ceph",
+        "hash_size": r.hash_size,
+        "replication_factor": r.replication_factor,
+        "hash": hash_settings(r.hash_fn),
+        "cache_size": r.cache.maxsize,
+        "workers": r.workers,
+        "storage_dir": r.storage_dir,
+        "mode": r.mode,
+        "cluster_map": r.cluster_map.layout() if r.cluster_map is not None else None,
+    }
+    arrays = {
+        "node_ids": np.array([node.id for node in r.node_array], dtype=np.int64),
+        "weights": np.array([node.weight for node in r.node_array], dtype=np.float64),
+        "capacities": np.array([np.nan if node.capacity is None else node.capacity for node in r.node_array], dtype=np.float64),
+        "thresholds": np.array([node.threshold for node in r.node_array], dtype=np.int64),
+        "store_sizes": np.array([len(node.store) for node in r.node_array], dtype=np.int64),
+        "values": np.concatenate([node.data_array for node in r.node_array] + [np.empty(0, dtype=np.int64)]),
+        "replica_ids": np.concatenate([node.replica_array for node in r.node_array] + [np.empty(0, dtype=np.int16)]).astype(np.int16),
+    }
+    return header, arrays
+
+def save(engine, path):
+    header, arrays = rush_state(engine) if isinstance(engine, RUSH) else cassandra_state(engine)
+
+    # Lay the arrays out after the header, each on an aligned offset
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        table[name] = {"dtype": array.dtype.str, "length": len(array), "offset": offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header["arrays"] = table
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGN) * ALIGN
+
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+def read(path, use_mmap=True):
+    # header and read-only array views over the file (memory-mapped) or its bytes
+    with open(path, "rb") as f:
+        if use_mmap:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = f.read()
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a DHT snapshot")
+    header_len = struct.unpack_from("<I", buffer, len(MAGIC))[0]
+    header = json.loads(bytes(buffer[len(MAGIC) + 4:len(MAGIC) + 4 + header_len]))
+    data_start = -(-(len(MAGIC) + 4 + header_len) // ALIGN) * ALIGN
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        arrays[name] = np.frombuffer(buffer, dtype=np.dtype(entry["dtype"]), count=entry["length"],
+                                     offset=data_start + entry["offset"])
+    return header, arrays
+
+def load_cassandra(header, arrays):
+    c = Cassandra.__new__(Cassandra)
+    c.ring_length = header["ring_length"]
+    c.replicas = header["replicas"]
+    c.vnodes = header["vnodes"]
+    c.next_id = header["next_id"]
+    c.storage_dir = header["storage_dir"]
+
+    primary = unpack_ranges(arrays["primary_starts"], arrays["primary_ends"], arrays["primary_counts"])
+    replicas = unpack_ranges(arrays["replica_starts"], arrays["replica_ends"], arrays["replica_counts"])
+    c.nodes = []
+    for i, node_id in enumerate(arrays["node_ids"].tolist()):
+        node = c.new_node(node_id, 0)
+        node.status = header["status"][i]
+        node.primary = primary[i]
+        node.replicas = replicas[i]
+        node.tokens = []
+        c.nodes.append(node)
+
+    by_id = {node.id: node for node in c.nodes}
+    c.tokens = arrays["tokens"].tolist()
+    c.token_nodes = [by_id[node_id] for node_id in arrays["token_node_ids"].tolist()]
+    for token, node in zip(c.tokens, c.token_nodes):
+        node.tokens.append(token)
+    for node in c.nodes:
+        node.value = node.tokens[0]
+    c.node_distance = int(c.ring_length / len(c.nodes))
+
+    # Relink the single token ring
+    if c.vnodes == 1:
+        for i, node in enumerate(c.token_nodes):
+            node.next = c.token_nodes[(i + 1) % len(c.token_nodes)]
+            node.prev = c.token_nodes[i - 1]
+    c.reindex()
+    return c
+
+def load_rush(header, arrays):
+    r = RUSH(header["hash_size"], header["replication_factor"], make_hash(header["hash"]),
+             header["cache_size"], header["workers"], header["storage_dir"], header["mode"],
+             ClusterMap.from_layout(header["cluster_map"]) if header["cluster_map"] is not None else None)
+    start = 0
+    for node_id, weight, capacity, threshold, size in zip(arrays["node_ids"].tolist(), arrays["weights"].tolist(),
+                                                          arrays["capacities"].tolist(), arrays["thresholds"].tolist(),
+                                                          arrays["store_sizes"].tolist()):
+        node = r.new_node(node_id)
+        node.weight = weight
+        node.capacity = None if math.isnan(capacity) else capacity
+        node.threshold = threshold
+        # the store reads straight from the snapshot and copies on its first write
+        node.store.values = arrays["values"][start:start+size]
+        node.store.replica_ids = arrays["replica_ids"][start:start+size]
+        node.store.size = size
+        r.node_array.append(node)
+        start += size
+    return r
+
+def load(path, use_mmap=True):
+    header, arrays = read(path, use_mmap)
+    if header["engine"] == "ceph":
+        return load_rush(header, arrays)
+    return load_cassandra(header, arrays)
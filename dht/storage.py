@@ -0,0 +1,180 @@
+import bisect
+import copy
+import hashlib
+import os
+import struct
+
+# Per-node key/value storage. Keys are bytes hashed into the ring (or RUSH) hash
+# space; a node keeps the payloads grouped by hash value, with a sorted index of
+# the hash values so that migrations can read or drop whole hash ranges at once.
+
+def to_bytes(data):
+    return data.encode() if isinstance(data, str) else bytes(data)
+
+def key_hash(key, hash_size):
+    # Position of a key in a hash space of hash_size values
+    digest = hashlib.blake2b(to_bytes(key), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % hash_size
+
+def open_storage(storage_dir, node_id):
+    # In-memory storage, or an append-only log per node when a directory is given
+    if storage_dir is None:
+        return MemoryEngine()
+    return LogEngine(os.path.join(storage_dir, f"node-{node_id}.log"))
+
+class MemoryEngine():
+    def __init__(self):
+        self.groups = {}    # hash value -> {key: value}
+        self.index = []     # sorted hash values that hold at least one key
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups.values())
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def put(self, hash_value, key, value):
+        group = self.groups.get(hash_value)
+        if group is None:
+            group = self.groups[hash_value] = {}
+            bisect.insort(self.index, hash_value)
+        group[key] = value
+
+    def get(self, hash_value, key):
+        group = self.groups.get(hash_value)
+        return None if group is None else group.get(key)
+
+    def delete(self, hash_value, key):
+        group = self.groups.get(hash_value)
+        if group is None or key not in group:
+            return False
+        del group[key]
+        if not group:
+            del self.groups[hash_value]
+            del self.index[bisect.bisect_left(self.index, hash_value)]
+        return True
+
+    def hashes_in(self, ranges):
+        # Stored hash values inside a RangeSet
+        hashes = []
+        for start, end in ranges.intervals():
+            hashes += self.index[bisect.bisect_left(self.index, start):bisect.bisect_left(self.index, end)]
+        return hashes
+
+    def export(self, hashes):
+        # (hash value, {key: value}) for every given hash value that is stored
+        return [(h, dict(self.groups[h])) for h in hashes if h in self.groups]
+
+    def export_ranges(self, ranges):
+        return self.export(self.hashes_in(ranges))
+
+    def load(self, groups):
+        # Bulk insert of exported groups, the index is re-sorted once
+        new_hashes = []
+        for hash_value, items in groups:
+            group = self.groups.get(hash_value)
+            if group is None:
+                group = self.groups[hash_value] = {}
+                new_hashes.append(hash_value)
+            group.update(items)
+        if new_hashes:
+            self.index += new_hashes
+            self.index.sort()
+
+    def drop(self, hashes):
+        hashes = set(hashes) & self.groups.keys()
+        if hashes:
+            for hash_value in hashes:
+                del self.groups[hash_value]
+            self.index = [h for h in self.index if h not in hashes]
+
+    def drop_ranges(self, ranges):
+        for start, end in ranges.intervals():
+            lo = bisect.bisect_left(self.index, start)
+            hi = bisect.bisect_left(self.index, end)
+            for hash_value in self.index[lo:hi]:
+                del self.groups[hash_value]
+            del self.index[lo:hi]
+
+    def clear(self):
+        self.groups = {}
+        self.index = []
+
+    def fork(self):
+        # A copy sharing the payload groups: each side holds its own hash values, so
+        # drops on one leave the other alone, while keys written into a group both
+        # hold show up in both. Backs a copy-on-write engine whose predecessor is
+        # only read from.
+        fork = copy.copy(self)
+        fork.groups = dict(self.groups)
+        fork.index = list(self.index)
+        return fork
+
+class LogEngine(MemoryEngine):
+    # MemoryEngine backed by an append-only log that is replayed on open.
+    # Record: op (b"P" put, b"D" delete) | hash value | key length | value length | key | value
+    RECORD = struct.Struct(">cQII")
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            self.replay()
+
+    def replay(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + self.RECORD.size <= len(data):
+            op, hash_value, key_len, value_len = self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+            if offset + key_len + value_len > len(data):
+                break   # torn write at the end of the log
+            key = data[offset:offset+key_len]
+            value = data[offset+key_len:offset+key_len+value_len]
+            offset += key_len + value_len
+            if op == b"P":
+                super().put(hash_value, key, value)
+            else:
+                super().delete(hash_value, key)
+
+    def encode(self, op, hash_value, key, value=b""):
+        return self.RECORD.pack(op, hash_value, len(key), len(value)) + key + value
+
+    def append(self, records):
+        if records:
+            with open(self.path, "ab") as f:
+                f.write(b"".join(records))
+
+    def put(self, hash_value, key, value):
+        self.append([self.encode(b"P", hash_value, key, value)])
+        super().put(hash_value, key, value)
+
+    def delete(self, hash_value, key):
+        if super().delete(hash_value, key):
+            self.append([self.encode(b"D", hash_value, key)])
+            return True
+        return False
+
+    def load(self, groups):
+        self.append([self.encode(b"P", h, key, value) for h, items in groups for key, value in items.items()])
+        super().load(groups)
+
+    def drop(self, hashes):
+        self.append([self.encode(b"D", h, key) for h, items in self.export(hashes) for key in items])
+        super().drop(hashes)
+
+    def drop_ranges(self, ranges):
+        self.append([self.encode(b"D", h, key) for h, items in self.export_ranges(ranges) for key in items])
+        super().drop_ranges(ranges)
+
+    def clear(self):
+        open(self.path, "wb").close()
+        super().clear()
+
+    def compact(self):
+        # Rewrite the log with only the live entries
+        records = [self.encode(b"P", h, key, value) for h in self.index for key, value in self.groups[h].items()]
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(b"".join(records))
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,191 @@
+from dht.provision import ENGINES, provision
+from dht.ceph import RUSH
+import argparse
+import json
+import time
+import numpy as np
+
+# Workload simulator: generates request keys from a skewed distribution, routes
+# them through an engine's placement and reports the request rate every node
+# sees, flagging hotspot nodes and hash ranges. Keys are positions in the hash
+# space, like the values search_data and locate take. A read is served by the
+# first replica, a write goes to every replica.
+#
+# Requests arrive at a fixed simulated rate, so per-node rates are also tracked
+# per time window to show the peaks that bursts cause.
+DISTRIBUTIONS = ("uniform", "zipf", "sequential", "bursty")
+
+def uniform_keys(rng, key_space, count):
+    return rng.integers(0, key_space, count, dtype=np.int64)
+
+def zipf_keys(rng, key_space, count, s=1.1, hot_keys=1 << 20):
+    # Truncated Zipf over the ranks of at most hot_keys distinct keys, scattered
+    # over the hash space so that popular keys are not neighbours
+    n = min(key_space, hot_keys)
+    cdf = np.cumsum(np.arange(1, n + 1, dtype=np.float64) ** -s)
+    ranks = np.searchsorted(cdf, rng.random(count) * cdf[-1])
+    return rng.choice(key_space, n, replace=False).astype(np.int64)[np.minimum(ranks, n - 1)]
+
+def sequential_keys(rng, key_space, count):
+    # A scan from a random start, wrapping around the hash space
+    return (int(rng.integers(0, key_space)) + np.arange(count, dtype=np.int64)) % key_space
+
+def bursty_keys(rng, key_space, count, burst_length=1000, burst_prob=0.1, burst_width=64, burst_fraction=0.9):
+    # Uniform background traffic. Every burst_length requests a burst starts with
+    # probability burst_prob, sending burst_fraction of its requests to a random
+    # span of burst_width neighbouring keys
+    keys = uniform_keys(rng, key_space, count)
+    for start in range(0, count, burst_length):
+        if rng.random() < burst_prob:
+            end = min(start + burst_length, count)
+            hit = np.flatnonzero(rng.random(end - start) < burst_fraction) + start
+            offset = int(rng.integers(0, key_space))
+            keys[hit] = (offset + rng.integers(0, min(burst_width, key_space), len(hit))) % key_space
+    return keys
+
+def generate(distribution, key_space, count, seed=0, **params):
+    rng = np.random.default_rng(seed)
+    if distribution == "uniform":
+        return uniform_keys(rng, key_space, count)
+    if distribution == "zipf":
+        return zipf_keys(rng, key_space, count, **params)
+    if distribution == "sequential":
+        return sequential_keys(rng, key_space, count)
+    if distribution == "bursty":
+        return bursty_keys(rng, key_space, count, **params)
+    raise ValueError(f"Unknown distribution '{distribution}'")
+
+def engine_nodes(engine):
+    return engine.node_array if isinstance(engine, RUSH) else engine.nodes
+
+def hash_ranges(engine, keys, num_ranges):
+    # (range index of every key, [(start, end, owner node id or None)]). Cassandra
+    # ranges are the token ranges, RUSH has none so the hash space is cut in equal slices.
+    if isinstance(engine, RUSH):
+        width = -(-engine.hash_size // num_ranges)
+        ranges = [(start, min(start + width, engine.hash_size), None) for start in range(0, engine.hash_size, width)]
+        return keys // width, ranges
+    tokens = np.array(engine.tokens, dtype=np.int64)
+    ranges = [((engine.tokens[i-1] + 1) % engine.ring_length, engine.tokens[i] + 1, engine.token_nodes[i].id)
+              for i in range(len(engine.tokens))]
+    return np.searchsorted(tokens, keys, side="left") % len(tokens), ranges
+
+def simulate(engine, keys, write_ratio=0.1, rate=10000.0, window=1.0, threshold=1.5, num_ranges=64, seed=0):
+    start_time = time.perf_counter()
+    keys = np.asarray(keys, dtype=np.int64)
+    writes = np.random.default_rng(seed).random(len(keys)) < write_ratio
+    replicas = engine.locate_many(keys)
+    nodes = engine_nodes(engine)
+    ids = np.array(sorted({node.id for node in nodes}), dtype=np.int64)
+
+    # One node request per read and one per replica of a write (vnode rows are padded with -1)
+    served = np.where(writes[:, None], replicas, np.where(np.arange(replicas.shape[1]) == 0, replicas, -1))
+    rows, cols = np.nonzero(served >= 0)
+    node_index = np.searchsorted(ids, served[rows, cols])
+    windows = (rows / rate // window).astype(np.int64)
+    num_windows = int(windows.max()) + 1 if len(windows) else 1
+    per_window = np.bincount(windows * len(ids) + node_index, minlength=num_windows * len(ids)).reshape(num_windows, len(ids))
+    totals = per_window.sum(axis=0)
+    mean = totals.mean() if len(ids) else 0.0
+    seconds = len(keys) / rate
+
+    report = {"requests": len(keys), "writes": int(writes.sum()), "simulated_seconds": seconds, "nodes": {},
+              "hot_nodes": [], "request_imbalance": float(totals.max() / mean) if mean > 0 else 1.0}
+    for i, node_id in enumerate(ids.tolist()):
+        hot = mean > 0 and totals[i] > threshold * mean
+        report["nodes"][str(node_id)] = {
+            "requests": int(totals[i]),
+            "rate": float(totals[i] / seconds) if seconds > 0 else 0.0,
+            "peak_rate": float(per_window[:, i].max() / window),
+            "hot": bool(hot),
+        }
+        if hot:
+            report["hot_nodes"].append(node_id)
+    peak = per_window.max(axis=0) / window
+    report["peak_imbalance"] = float(peak.max() / peak.mean()) if peak.mean() > 0 else 1.0
+
+    # Ranges getting more than threshold times the mean requests per range
+    range_index, ranges = hash_ranges(engine, keys, num_ranges)
+    counts = np.bincount(range_index, minlength=len(ranges))
+    range_mean = len(keys) / len(ranges)
+    report["hot_ranges"] = [{"start": ranges[i][0], "end": ranges[i][1], "node": ranges[i][2],
+                             "requests": int(counts[i]), "share": float(counts[i] / len(keys))}
+                            for i in np.argsort(-counts, kind="stable").tolist() if counts[i] > threshold * range_mean]
+    report["seconds"] = time.perf_counter() - start_time
+    return report
+
+def balance(engine, keys, report, policy):
+    # Apply a load balancing policy after a simulation, returns the number of values moved.
+    # "auto" evens out stored values (cassandra), "hotspot" moves requests away from the
+    # busiest node (ceph) or the busiest token range (cassandra)
+    if policy == "auto":
+        if isinstance(engine, RUSH):
+            raise ValueError("auto balancing is only implemented for cassandra")
+        return engine.auto_balance()["values_moved"]
+    if policy != "hotspot":
+        raise ValueError(f"Unknown balance policy '{policy}'")
+    if not report["hot_nodes"] and not report["hot_ranges"]:
+        return 0    # nothing above the threshold, moving would only add imbalance
+    if isinstance(engine, RUSH):
+        # weights of the busiest and idlest node scaled towards the mean request
+        # count, at most halved or doubled
+        by_id = {node.id: node for node in engine.node_array}
+        requests = {int(node_id): stats["requests"] for node_id, stats in report["nodes"].items()}
+        hot = max(requests, key=requests.get)
+        cold = min(requests, key=requests.get)
+        if hot == cold:
+            return 0
+        mean = sum(requests.values()) / len(requests)
+        hot_weight = by_id[hot].weight * max(0.5, mean / requests[hot])
+        cold_weight = by_id[cold].weight * min(2.0, mean / max(requests[cold], 1))
+        return len(engine.load_balance([hot, hot_weight], [cold, cold_weight]))
+    if engine.vnodes > 1:
+        raise ValueError("hotspot balancing moves single tokens, the ring has vnodes")
+    # Move the token of the busiest range back to the median requested key, which
+    # hands the upper half of the range's requests to the successor
+    keys = np.asarray(keys, dtype=np.int64)
+    range_index, _ = hash_ranges(engine, keys, 0)
+    i = int(np.bincount(range_index, minlength=len(engine.tokens)).argmax())
+    node = engine.token_nodes[i]
+    distance = (engine.tokens[i] - keys[range_index == i]) % engine.ring_length
+    num_values = min(int(np.median(distance)), engine.section_len(node) - 1)
+    if num_values < 1:
+        return 0
+    return len(engine.shrink_right(node, num_values).get("hash_values"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a skewed workload against an engine and flag hotspot nodes and ranges")
+    parser.add_argument("--engine", default="cassandra", choices=ENGINES)
+    parser.add_argument("--nodes", default=8, type=int)
+    parser.add_argument("--hash-bits", default=16, type=int)
+    parser.add_argument("--replicas", default=3, type=int)
+    parser.add_argument("--vnodes", default=1, type=int, help="tokens per cassandra node")
+    parser.add_argument("--distribution", default="zipf", choices=DISTRIBUTIONS)
+    parser.add_argument("--zipf-s", default=1.1, type=float, help="zipf exponent, higher is more skewed")
+    parser.add_argument("--burst-width", default=64, type=int, help="neighbouring keys a burst hits")
+    parser.add_argument("--requests", default=100000, type=int)
+    parser.add_argument("--write-ratio", default=0.1, type=float)
+    parser.add_argument("--rate", default=10000.0, type=float, help="simulated requests per second")
+    parser.add_argument("--window", default=1.0, type=float, help="seconds per rate window")
+    parser.add_argument("--threshold", default=1.5, type=float, help="flag nodes and ranges above this multiple of the mean")
+    parser.add_argument("--ranges", default=64, type=int, help="hash space slices for ceph (cassandra uses its token ranges)")
+    parser.add_argument("--balance", choices=["auto", "hotspot"], help="balance after the run and replay the same keys")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args(argv)
+
+    engine = provision(args.engine, args.nodes, 2 ** args.hash_bits, args.replicas, args.vnodes)
+    params = {}
+    if args.distribution == "zipf":
+        params["s"] = args.zipf_s
+    elif args.distribution == "bursty":
+        params["burst_width"] = args.burst_width
+    keys = generate(args.distribution, 2 ** args.hash_bits, args.requests, args.seed, **params)
+    run = lambda: simulate(engine, keys, args.write_ratio, args.rate, args.window, args.threshold, args.ranges, args.seed)
+    result = {"engine": args.engine, "distribution": args.distribution, "before": run()}
+    if args.balance:
+        result["values_moved"] = balance(engine, keys, result["before"], args.balance)
+        result["after"] = run()
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
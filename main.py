@@ -1,76 +1,190 @@
+from dht.provision import provision
 from dht.ceph import RUSH
 from dht.cassandra import Cassandra
-from dht import questions as inq
+from dht import metrics, repair, snapshot, workload
+import argparse
+import sys
 import time
-from PyInquirer import style_from_dict, Token, prompt
-
-
-# Prompt style
-style = style_from_dict({
-    Token.Separator: '#cc5454',
-    Token.QuestionMark: '#673ab7 bold',
-    Token.Selected: '#cc5454',  # default
-    Token.Pointer: '#673ab7 bold',
-    Token.Instruction: '',  # default
-    Token.Answer: '#f44336 bold',
-    Token.Question: '',
-})
-
-# Setup prompt
-answers = prompt(inq.setup_prompt(), style=style)
-num_nodes = int(answers.get("num_nodes"))
-algorithm = answers.get("algorithm")
-
-# Initializations
-replication_factor = int(answers.get("replicas"))
-hash_size = 2 ** int(answers.get("hash_space_size"))
-
-# Initialize algorithm
-print(f"Provisioning {num_nodes} nodes...")
-if algorithm == "ceph":
-    c = RUSH(hash_size,replication_factor)
-    for i in range(num_nodes):
-        c.add_node(i)
-    c.add_data() # add data to the nodes initially
-else:
-    c = Cassandra(num_nodes, hash_size, replication_factor)
-    
-# Print initial node structure
-time.sleep(1)
-print(c)
-print("Setup complete!")
-
-# Prompt until a program exit
-while True:
-    answers = prompt(inq.system_event_prompt(c), style=style)
-    action = answers.get("action")
-    if action == "exit":
-        break
-    elif action=="add_node":
-        if algorithm != "ceph":
+
+
+def run_interactive():
+    from PyInquirer import style_from_dict, Token, prompt
+    from dht import questions as inq
+
+    # Prompt style
+    style = style_from_dict({
+        Token.Separator: '#cc5454',
+        Token.QuestionMark: '#673ab7 bold',
+        Token.Selected: '#cc5454',  # default
+        Token.Pointer: '#673ab7 bold',
+        Token.Instruction: '',  # default
+        Token.Answer: '#f44336 bold',
+        Token.Question: '',
+    })
+
+    # Setup prompt
+    answers = prompt(inq.setup_prompt(), style=style)
+    num_nodes = int(answers.get("num_nodes"))
+    algorithm = answers.get("algorithm")
+
+    # Initializations
+    replication_factor = int(answers.get("replicas"))
+    hash_size = 2 ** int(answers.get("hash_space_size"))
+
+    # Initialize algorithm
+    print(f"Provisioning {num_nodes} nodes...")
+    c = provision(algorithm, num_nodes, hash_size, replication_factor)
+
+    # Print initial node structure
+    time.sleep(1)
+    print(c)
+    print("Setup complete!")
+
+    # Prompt until a program exit
+    while True:
+        answers = prompt(inq.system_event_prompt(c), style=style)
+        action = answers.get("action")
+        if action == "exit":
+            break
+        elif action=="add_node":
+            if algorithm != "ceph":
+                node_id = int(answers.get("node_id"))
+                c.add_node(node_id)
+                print(c)
+            else:
+                c.add_new_node()
+                print(c)
+        elif action=="remove_node":
             node_id = int(answers.get("node_id"))
-            c.add_node(node_id)
+            c.remove_node(node_id)
             print(c)
-        else:
-            c.add_new_node()
+        elif action=="locate_data":
+            value = int(answers.get("hashed_data_locate"))
+            c.search_data(value)
+            #print(f"{value} Located on Node {node.id}")
+        elif action=="load_balance":
+            if type(c) == RUSH:
+                print("Table before load balancing")
+                print(c)
+                over = answers.get("overloaded").split(' ')
+                under = answers.get("underloaded").split(' ')
+            elif type(c) == Cassandra:
+                over = int(answers.get("overloaded"))
+                under = int(answers.get("underloaded"))
+            c.load_balance(over, under)
             print(c)
-    elif action=="remove_node":
-        node_id = int(answers.get("node_id"))
-        c.remove_node(node_id)
-        print(c)
-    elif action=="locate_data":
-        value = int(answers.get("hashed_data_locate"))
-        c.search_data(value)
-        #print(f"{value} Located on Node {node.id}")
-    elif action=="load_balance":
+
+
+# Batch operations, one per line ('#' starts a comment):
+#   setup <cassandra|ceph|straw2|crush> <num_nodes> <hash_space_size> <replicas> [vnodes]
+#   load <snapshot_file>         (instead of setup, memory-maps a saved ring)
+#   save <snapshot_file>
+#   add_node [node_value]        (the value is required for cassandra, ignored for ceph)
+#   add_node [rack] [host]       (crush: where the new node goes in the cluster map)
+#   remove_node <node_value|node_id>  (cassandra streams the node's ranges to their new owners)
+#   mark_down <node_value>       (cassandra: writes for the node are kept as hints)
+#   mark_up <node_value>         (cassandra: replays the hints)
+#   locate <hash_value>
+#   put <key> <value>
+#   get <key>                    (prints the value)
+#   delete <key>
+#   load_balance <overloaded_value> <underloaded_value>                       (cassandra)
+#   load_balance <over_id> <over_weight> <under_id> <under_weight>          (ceph)
+#   capacity <node_id> <capacity>                                           (ceph)
+#   auto_balance <target_ratio> [max_values_per_round]                      (cassandra)
+#   repair [merkle_tree_depth]                                               (cassandra)
+#   metrics [prometheus|json]    (with --metrics: prints the metrics recorded so far)
+#   workload <uniform|zipf|sequential|bursty> <requests> [write_ratio]  (prints hotspot nodes and ranges)
+def run_op(c, op, args):
+    if op == "add_node":
         if type(c) == RUSH:
-            print("Table before load balancing")
-            print(c)
-            over = answers.get("overloaded").split(' ')
-            under = answers.get("underloaded").split(' ')
-        elif type(c) == Cassandra:
-            over = int(answers.get("overloaded"))
-            under = int(answers.get("underloaded"))
-        c.load_balance(over, under)
-        print(c)
+            c.add_new_node(0, *args[:2])
+        else:
+            c.add_node(int(args[0]))
+    elif op == "remove_node":
+        c.remove_node(int(args[0]))
+    elif op == "mark_down":
+        c.mark_down(int(args[0]))
+    elif op == "mark_up":
+        c.mark_up(int(args[0]))
+    elif op == "locate":
+        c.find_replicas(int(args[0]))
+    elif op == "put":
+        c.put(args[0], args[1])
+    elif op == "get":
+        value = c.get(args[0])
+        print(value.decode() if value is not None else f"Key {args[0]} was not found!")
+    elif op == "delete":
+        c.delete(args[0])
+    elif op == "auto_balance":
+        report = c.auto_balance(float(args[0]), int(args[1]) if len(args) > 1 else None)
+        ratios = ' '.join(f"{ratio:.3f}" for ratio in report["ratio_history"])
+        print(f"{'Converged' if report['converged'] else 'Stopped'} after {report['rounds']} rounds, "
+              f"{report['values_moved']} values moved, busiest/mean per round: {ratios}")
+    elif op == "repair":
+        report = repair.repair(c, int(args[0]) if args else 8)
+        print(f"Repaired {report['ranges']} ranges: {report['divergent_leaves']} of {report['leaves']} "
+              f"leaves differed, {report['entries_written']} entries written, {report['stale_dropped']} stale dropped")
+    elif op == "workload":
+        space = c.hash_size if type(c) == RUSH else c.ring_length
+        keys = workload.generate(args[0], space, int(args[1]))
+        report = workload.simulate(c, keys, float(args[2]) if len(args) > 2 else 0.1)
+        hot_ranges = ' '.join(f"[{r['start']}, {r['end']}) {r['share']:.1%}" for r in report["hot_ranges"][:5])
+        print(f"Busiest/mean node requests {report['request_imbalance']:.3f}, "
+              f"hot nodes: {report['hot_nodes'] or 'none'}, hot ranges: {hot_ranges or 'none'}")
+    elif op == "capacity":
+        c.set_capacity(int(args[0]), float(args[1]))
+    elif op == "save":
+        snapshot.save(c, args[0])
+    elif op == "load_balance":
+        if type(c) == RUSH:
+            c.load_balance(args[0:2], args[2:4])
+        else:
+            c.load_balance(int(args[0]), int(args[1]), verbose=False)
+    else:
+        raise ValueError(f"Unknown operation '{op}'")
+
+
+def run_batch(stream, timing=False, metrics_format=None):
+    c = None
+    for line_num, line in enumerate(stream, 1):
+        words = line.split('#')[0].split()
+        if not words:
+            continue
+        op, args = words[0], words[1:]
+
+        start = time.perf_counter()
+        if op == "setup":
+            c = provision(args[0], int(args[1]), 2 ** int(args[2]), int(args[3]), int(args[4]) if len(args) > 4 else 1)
+        elif op == "load":
+            c = snapshot.load(args[0])
+        elif c is None:
+            raise ValueError(f"Line {line_num}: '{op}' before setup")
+        elif op == "metrics":
+            if not metrics_format:
+                raise ValueError(f"Line {line_num}: 'metrics' needs --metrics")
+            print(metrics.export(c, args[0] if args else metrics_format))
+        else:
+            run_op(c, op, args)
+        if metrics_format and op in ("setup", "load"):
+            metrics.instrument(c)
+        if timing:
+            print(f"{line_num} {op} {(time.perf_counter() - start) * 1000:.3f} ms")
+    if metrics_format and c is not None:
+        print(metrics.export(c, metrics_format))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DHT ring implementation of Cassandra and Ceph")
+    parser.add_argument("--batch", metavar="FILE", help="run the operations in FILE ('-' for stdin) without prompts")
+    parser.add_argument("--timing", action="store_true", help="print the time taken by each batch operation")
+    parser.add_argument("--metrics", choices=["prometheus", "json"], help="instrument the engine and print its metrics after the batch")
+    args = parser.parse_args()
 
+    if args.batch is None:
+        run_interactive()
+    elif args.batch == "-":
+        run_batch(sys.stdin, args.timing, args.metrics)
+    else:
+        with open(args.batch) as f:
+            run_batch(f, args.timing, args.metrics)
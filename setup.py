@@ -1,7 +1,8 @@
 from setuptools import find_packages, setup
 
 REQUIRES = ["PyInquirer",
-            "prettytable"]
+            "prettytable",
+            "numpy"]
 
 setup(
     name="dht",
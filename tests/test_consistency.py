@@ -0,0 +1,41 @@
+from dht.consistency import ALL, ONE, QUORUM, Coordinator, UnavailableError
+from dht.provision import provision
+import asyncio
+import pytest
+
+# Acks count once per distinct node, a node holding two replicas of a key can
+# not make up for a missing one.
+
+class Node():
+    def __init__(self, id):
+        self.id = id
+        self.status = "RUNNING"
+
+class Engine():
+    replicas = 3
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def hash_key(self, key):
+        return 0
+
+    def find_replicas(self, hash_value):
+        return self.nodes
+
+def test_duplicate_replicas_ack_once():
+    a, b = Node(2), Node(3)
+    coordinator = Coordinator()
+    nodes, replication_factor = coordinator.replica_set(Engine([a, a, b]), 0, False)
+    assert nodes == [a, b] and replication_factor == 3
+    with pytest.raises(UnavailableError):
+        asyncio.run(coordinator.fan_out(nodes, 3, lambda node: node.id, False))
+    assert sorted(asyncio.run(coordinator.fan_out(nodes, 2, lambda node: node.id, False))) == [2, 3]
+
+@pytest.mark.parametrize("engine_type", ["cassandra", "ceph", "crush"])
+def test_levels_write_distinct_nodes(engine_type):
+    engine = provision(engine_type, 8, 2 ** 10, 3)
+    coordinator = Coordinator()
+    for level in (ONE, QUORUM, ALL):
+        acked = asyncio.run(coordinator.write(engine, f"key-{level}", "value", level))
+        assert len(acked) == len(set(acked))
@@ -0,0 +1,19 @@
+from dht.ceph import RUSH
+from dht.hashing import SplitMixHash
+import numpy as np
+
+# The scalar hash takes NumPy integers as well as ints, with the same result,
+# and agrees with the batch form.
+
+def test_numpy_integers():
+    hash_fn = SplitMixHash(7)
+    assert hash_fn(np.int64(12345), np.int64(2), np.int64(-3)) == hash_fn(12345, 2, -3)
+    assert hash_fn(np.int64(12345), 2, 5) == hash_fn.array([12345], [2], np.int64(5))[0]
+
+def test_locate_numpy_key():
+    r = RUSH(2 ** 10, 3)
+    for i in range(8):
+        r.add_node(i)
+    r.add_data()
+    for key in range(0, 2 ** 10, 37):
+        assert r.locate_data(np.int64(key), 1) is r.locate_data(key, 1)
@@ -0,0 +1,44 @@
+from dht.cassandra import Cassandra
+import numpy as np
+import pytest
+
+# Ranges a single-token ring tracks through node additions have to match the
+# ranges rebuilt from its tokens, and every write has to reach all replicas.
+
+def ownership(ring):
+    return {node.id: (node.primary.copy(), node.replicas.copy()) for node in ring.nodes}
+
+@pytest.mark.parametrize("replicas", [1, 2, 3, 8, 9])
+def test_add_node_matches_tokens(replicas):
+    ring = Cassandra(8, 4096, replicas)
+    for i in range(200):
+        ring.put(f"key-{i}", "value")
+    for value in (100, 1000, 1001, 3000):
+        ring.add_node(value)
+        tracked = ownership(ring)
+        ring.assign_ownership()
+        assert tracked == ownership(ring)
+
+    keys = np.arange(ring.ring_length)
+    located = ring.locate_many(keys)
+    for hash_value in keys.tolist():
+        assert sorted(node.id for node in ring.find_replicas(hash_value)) == sorted(set(located[hash_value].tolist()))
+
+    # payloads live on exactly the replicas of their keys
+    for i in range(200):
+        hash_value = ring.hash_key(f"key-{i}")
+        holders = {node.id for node in ring.nodes if node.storage.get(hash_value, f"key-{i}".encode()) is not None}
+        assert holders == {node.id for node in ring.find_replicas(hash_value)}
+
+@pytest.mark.parametrize("replicas", [1, 3])
+def test_auto_balance_matches_tokens(replicas):
+    ring = Cassandra(8, 2 ** 14, replicas)
+    for value in (100, 200, 5000):
+        ring.add_node(value)
+    report = ring.auto_balance(1.05)
+    assert report["values_moved"] > 0
+    tracked = ownership(ring)
+    ring.assign_ownership()
+    assert tracked == ownership(ring)
+    if replicas == 1:
+        assert all(not node.replicas for node in ring.nodes)
@@ -0,0 +1,52 @@
+from dht.provision import provision
+import numpy as np
+import pytest
+
+# Every key gets replication_factor distinct nodes when there are enough nodes
+# (racks for crush, the default map has 4), and the scalar and batch placement agree.
+
+@pytest.mark.parametrize("engine_type,num_nodes,replicas", [
+    ("straw2", 3, 3),
+    ("straw2", 8, 3),
+    ("straw2", 16, 5),
+    ("crush", 3, 3),
+    ("crush", 8, 3),
+    ("crush", 16, 4),
+])
+def test_distinct_replicas(engine_type, num_nodes, replicas):
+    engine = provision(engine_type, num_nodes, 2 ** 12, replicas)
+    keys = np.arange(engine.hash_size)
+    located = engine.locate_many(keys)
+    assert all(len(set(row)) == replicas for row in located.tolist())
+    for key in keys[::97].tolist():
+        scalar = [engine.walk(key, r).id for r in range(1, replicas + 1)]
+        assert scalar == located[key].tolist()
+
+def test_distinct_replicas_after_changes():
+    engine = provision("straw2", 6, 2 ** 12, 3)
+    engine.add_new_node()
+    engine.remove_node(2)
+    engine.set_capacity(4, 3.0)
+    keys = np.arange(engine.hash_size)
+    assert all(len(set(row)) == 3 for row in engine.locate_many(keys).tolist())
+    for node in engine.node_array:
+        for value in node.data_array.tolist()[::50]:
+            assert node.value_in_node(value)
+
+# Rebalancing only places again the pairs a change can move, which must leave
+# every stored pair where a full placement puts it
+@pytest.mark.parametrize("engine_type", ["ceph", "straw2", "crush"])
+def test_rebalance_matches_full_placement(engine_type):
+    engine = provision(engine_type, 8, 2 ** 12, 3)
+    changes = [lambda: engine.add_new_node(), lambda: engine.remove_node(3),
+               lambda: engine.load_balance([1, 0.05], [2, 0.2])]
+    if engine_type != "ceph":
+        changes.append(lambda: engine.set_capacity(4, 30.0))
+    for change in changes:
+        before = engine.locate_many(np.arange(engine.hash_size))
+        plan = change()
+        values, replica_ids, owners = engine.stored_pairs(engine.node_array)
+        assert np.array_equal(engine.assign_batch(values, replica_ids), owners)
+        after = engine.locate_many(np.arange(engine.hash_size))
+        assert len(plan) == int((before != after).sum())
+        assert np.array_equal(after[plan.value, plan.replica_id - 1], plan.dest)
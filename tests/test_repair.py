@@ -0,0 +1,25 @@
+from dht.cassandra import Cassandra
+from dht.repair import repair
+
+# Nodes holding keys of a range they do not replicate hand off only the keys no
+# replica has, take no part in the tree comparison and drop the range.
+
+def test_stale_holder_hands_off_and_drops():
+    ring = Cassandra(8, 2 ** 12, 3)
+    for i in range(500):
+        ring.put(f"k{i}", f"v{i}")
+    hash_value = ring.hash_key("k0")
+    replicas = ring.find_replicas(hash_value)
+    stale = next(node for node in ring.nodes if node not in replicas)
+    stale.storage.put(hash_value, b"k0", b"old")
+    stale.storage.put(hash_value, b"lost", b"found")
+
+    report = repair(ring)
+    assert report["divergent_leaves"] == 0
+    assert report["handed_off"] == len(replicas)
+    assert report["stale_dropped"] == 1
+    assert stale.storage.get(hash_value, b"k0") is None
+    for node in replicas:
+        assert node.storage.get(hash_value, b"k0") == b"v0"
+        assert node.storage.get(hash_value, b"lost") == b"found"
+    assert stale.storage.get(hash_value, b"lost") is None
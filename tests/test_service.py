@@ -0,0 +1,40 @@
+from dht.provision import provision
+from dht.service import DHTService
+from dht import service
+import asyncio
+import copy
+import threading
+
+# A topology change is copied and applied off the event loop: a lookup sent
+# while the engine is being copied is answered before the copy finishes, and
+# readers of the old engine still find every key afterwards.
+
+def test_lookup_during_topology_change(monkeypatch):
+    engine = provision("cassandra", 8, 2 ** 10, 3)
+    for i in range(200):
+        engine.put(f"k{i}", f"v{i}")
+    dht = DHTService(engine)
+    release = threading.Event()
+    copied = []
+    deepcopy = copy.deepcopy
+
+    def slow_deepcopy(*args, **kwargs):
+        release.wait(2)
+        copied.append(True)
+        return deepcopy(*args, **kwargs)
+
+    async def run():
+        monkeypatch.setattr(service.copy, "deepcopy", slow_deepcopy)
+        change = asyncio.ensure_future(dht.dispatch({"op": "add_node", "value": 333}))
+        await asyncio.sleep(0.01)
+        located = await dht.dispatch({"op": "locate", "key": 42})
+        assert not copied and not change.done()
+        release.set()
+        assert await change == 9
+        return located
+
+    located = asyncio.run(run())
+    assert located == [node.id for node in engine.find_replicas(42)]
+    for i in range(200):
+        assert engine.get(f"k{i}") == f"v{i}".encode()
+        assert dht.engine.get(f"k{i}") == f"v{i}".encode()
@@ -0,0 +1,43 @@
+from dht.provision import provision
+from dht.ceph import RUSH
+from dht import snapshot
+import numpy as np
+import pytest
+
+# A saved and memory-mapped engine answers every lookup like the original,
+# also after the same topology change on both.
+HASH_SIZE = 2 ** 10
+KEYS = np.arange(0, HASH_SIZE, 7)
+
+def replica_ids(engine, key):
+    if isinstance(engine, RUSH):
+        return [(replica_id, node.id) for replica_id, node in engine.find_replicas(key)]
+    return [node.id for node in engine.find_replicas(key)]
+
+def assert_same_lookups(engine, loaded):
+    assert np.array_equal(engine.locate_many(KEYS), loaded.locate_many(KEYS))
+    for key in KEYS.tolist():
+        assert replica_ids(engine, key) == replica_ids(loaded, key)
+
+@pytest.mark.parametrize("engine_type,vnodes", [
+    ("cassandra", 1),
+    ("cassandra", 8),
+    ("ceph", 1),
+    ("straw2", 1),
+    ("crush", 1),
+])
+def test_round_trip(tmp_path, engine_type, vnodes):
+    engine = provision(engine_type, 8, HASH_SIZE, 3, vnodes)
+    path = str(tmp_path / "ring.snap")
+    snapshot.save(engine, path)
+    loaded = snapshot.load(path)
+    assert_same_lookups(engine, loaded)
+
+    for c in (engine, loaded):
+        if isinstance(c, RUSH):
+            c.add_new_node()
+            c.remove_node(3)
+        else:
+            c.add_node(333)
+            c.remove_node(c.tokens[2])
+    assert_same_lookups(engine, loaded)
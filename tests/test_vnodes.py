@@ -0,0 +1,17 @@
+from dht.cassandra import Cassandra
+import pytest
+
+# Every value of a vnode ring has exactly one primary owner.
+
+def test_primary_ranges_partition_the_ring():
+    for num_nodes, ring_length, vnodes in ((8, 16, 2), (4, 16, 4), (8, 4096, 16)):
+        ring = Cassandra(num_nodes, ring_length, 3, vnodes)
+        assert sum(len(node.primary) for node in ring.nodes) == ring_length
+        free = [value for value in range(ring_length) if value not in ring.tokens]
+        if free:
+            ring.add_node(free[-1])
+            assert sum(len(node.primary) for node in ring.nodes) == ring_length
+
+def test_more_tokens_than_ring_values():
+    with pytest.raises(ValueError):
+        Cassandra(8, 16, 3, vnodes=4)